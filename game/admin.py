@@ -14,9 +14,11 @@ from django_object_actions import DjangoObjectActions
 from sortedm2m_filter_horizontal_widget.forms import SortedFilteredSelectMultiple
 
 from components.models import Component
-from game.models import Series, Game, Question, Answer, AnswerCode
+from game.models import Series, Game, Question, Answer, AnswerCode, HistoricalAnswerCode
 from game.mail import send_winner_notice
+from game.rollups import clear_autocode_matchers, learn_rollups, rollup_profile_summary
 from leaderboard.leaderboard import tabulate_results, winners_of_game, clear_leaderboard_cache
+from leaderboard.rescoring import rescore_answer_codes
 from project.utils import slackit
 from users.utils import player_log_entry
 from game.utils import game_log_entry
@@ -124,8 +126,9 @@ class GameAdmin(DjangoObjectActions, admin.ModelAdmin):
 
     def _score_game(self, request, game, update=False):
         try:
-            tabulate_results(game, update)
+            rollup_profile = tabulate_results(game, update)
             self.message_user(request, f"{game.name} has successfully been scored!")
+            self.message_user(request, rollup_profile_summary(rollup_profile))
         except Exception as e:
             self.message_user(request, "An unexpected error occurred. Ping Ted.", level=messages.ERROR)
             logging.error("Exception occurred", exc_info=True)
@@ -215,3 +218,20 @@ class AnswerCodeAdmin(admin.ModelAdmin):
 
     def game(self, obj):
         return obj.game
+
+    def save_model(self, request, obj, form, change):
+        # a recoded answer only needs its question and the affected players rescored
+        if change and form.changed_data == ["coded_answer"] and obj.question.game is not None:
+            rescore_answer_codes(obj.question.game, obj.question, {obj.raw_string: obj.coded_answer})
+            self.message_user(request, f"{obj.question.game.name} has been rescored.")
+        else:
+            super().save_model(request, obj, form, change)
+            clear_autocode_matchers([obj.question])
+            if obj.question.game is not None:
+                learn_rollups(obj.question.game, {obj.question.text: {obj.raw_string: obj.coded_answer}})
+
+
+@admin.register(HistoricalAnswerCode)
+class HistoricalAnswerCodeAdmin(admin.ModelAdmin):
+    list_display = ("coded_answer", "raw_string", "question_text", "game", "updated")
+    search_fields = ("coded_answer", "raw_string", "question_text")
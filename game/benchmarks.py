@@ -0,0 +1,292 @@
+"""
+Synthetic answers, legacy reference implementations and timing helpers for answer coding and responses.
+"""
+
+import random
+import string
+from collections import deque
+from copy import deepcopy
+
+import pandas as pd
+from fuzzywuzzy import fuzz
+from pytz import timezone
+
+from game.models import Answer
+from game.gsheets_api import clear_responses_sync, get_sheet_doc, sync_responses_sheet
+from game.rollups import AutocodeMatcher, close_enough, process_rollups
+from game.tasks import changed_answers, raw_answers_db_to_df
+from leaderboard.benchmarks import time_call, time_runs
+
+SEED_ANSWERS = [
+    "Ontario",
+    "Quebec",
+    "British Columbia",
+    "Nova Scotia",
+    "New Brunswick",
+    "Wimbledon",
+    "US Open",
+    "French Open",
+    "Australian Open",
+    "Castaway",
+    "Big",
+    "The Terminal",
+    "Saving Private Ryan",
+    "Toy Story",
+    "Face Up",
+    "Face Down",
+    "Sourdough",
+    "Pretzel Rods",
+    "4",
+    "Four",
+    "12",
+    "Twelve",
+]
+
+
+def synthetic_raw_counts(n_responses=20000, n_seed_answers=len(SEED_ANSWERS), max_typos=3, seed=0):
+    """
+    Raw responses to one question: popular answers with random typos, casing and padding, so most
+    unique strings are a few edits away from a popular answer
+    :return: value counts of the raw responses, as passed to process_rollups
+    """
+    rng = random.Random(seed)
+    answers = SEED_ANSWERS[:n_seed_answers]
+    weights = [1 / (rank + 1) for rank in range(len(answers))]
+
+    def misspell(answer):
+        chars = list(answer)
+        for _ in range(rng.randint(0, max_typos)):
+            i = rng.randrange(len(chars) + 1)
+            op = rng.random()
+            if op < 0.3 and chars:
+                chars.pop(min(i, len(chars) - 1))
+            elif op < 0.6:
+                chars.insert(i, rng.choice(string.ascii_lowercase))
+            elif chars:
+                chars[min(i, len(chars) - 1)] = rng.choice(string.ascii_lowercase)
+        response = "".join(chars)
+        if rng.random() < 0.2:
+            response = response.lower()
+        if rng.random() < 0.1:
+            response = f" {response} "
+        return response
+
+    responses = [misspell(a) for a in rng.choices(answers, weights=weights, k=n_responses)]
+    return pd.Series(responses).value_counts()
+
+
+def legacy_process_rollups(col_name, raw_counts, user_rollups):
+    """The original process_rollups, which tries close_enough() against every rollup so far"""
+    rollups = user_rollups.get(col_name, [])
+    updated_counts = {}
+    processed_rollups = {}
+    resolved = {}
+    for unique_resp, count in (
+        raw_counts.sort_index(axis=0, ascending=False).sort_values(axis=0, ascending=False).items()
+    ):
+        if unique_resp not in resolved:
+            resolved[unique_resp] = True
+        else:
+            continue
+
+        if unique_resp in rollups:
+            recode_val = rollups[unique_resp]
+            if recode_val in updated_counts:
+                updated_counts[recode_val] += count
+                processed_rollups[recode_val].append(unique_resp)
+            else:
+                updated_counts[recode_val] = count
+                processed_rollups[recode_val] = [unique_resp]
+            continue
+
+        is_merged = False
+        for rollup_name in list(processed_rollups.keys()):
+            if close_enough(unique_resp, rollup_name, rollups):
+                is_merged = True
+                recode_val = rollup_name
+                if recode_val in updated_counts:
+                    updated_counts[recode_val] += count
+                    processed_rollups[recode_val].append(unique_resp)
+                else:
+                    updated_counts[recode_val] = count
+                    processed_rollups[recode_val] = [unique_resp]
+                break
+
+        if is_merged:
+            continue
+
+        processed_rollups[unique_resp] = [unique_resp]
+        updated_counts[unique_resp] = count
+
+    return updated_counts, processed_rollups
+
+
+def legacy_autorollup(coded_answers, raw_player_answer):
+    """The original autorollup_question_answer, which tries every AnswerCode of the question"""
+    if raw_player_answer in coded_answers:
+        return coded_answers[raw_player_answer]
+
+    coded_player_answer = raw_player_answer
+    best_score = 0
+    for raw_string, coded_answer in coded_answers.items():
+        if close_enough(raw_player_answer, raw_string, []):
+            return coded_answer
+        if (score := fuzz.ratio(raw_player_answer, raw_string)) > best_score:
+            best_score = score
+            coded_player_answer = coded_answer
+    return coded_player_answer
+
+
+def benchmark_process_rollups(n_responses=20000, repeat=1):
+    raw_counts = synthetic_raw_counts(n_responses)
+    legacy = time_call(legacy_process_rollups, "q", raw_counts, {}, repeat=repeat)
+    indexed = time_call(process_rollups, "q", raw_counts, {}, repeat=repeat)
+    return {
+        "unique_responses": len(raw_counts),
+        "legacy_seconds": legacy,
+        "indexed_seconds": indexed,
+        "speedup": legacy / indexed,
+    }
+
+
+def benchmark_autocode(n_responses=20000, n_answers=1000, repeat=1):
+    """Times coding n_answers unseen responses against the codes process_rollups made from the rest"""
+    raw_counts = synthetic_raw_counts(n_responses)
+    answers = list(raw_counts.index[:n_answers])
+    _, processed = process_rollups("q", raw_counts.iloc[n_answers:], {})
+    coded_answers = {raw: code for code, raws in processed.items() for raw in raws}
+
+    def autocode_all(autocode):
+        return [autocode(answer) for answer in answers]
+
+    legacy = time_call(autocode_all, lambda answer: legacy_autorollup(coded_answers, answer), repeat=repeat)
+    matcher = AutocodeMatcher(coded_answers)
+    indexed = time_call(autocode_all, matcher.autocode, repeat=repeat)
+    return {
+        "raw_strings": len(coded_answers),
+        "legacy_seconds": legacy,
+        "indexed_seconds": indexed,
+        "speedup": legacy / indexed,
+    }
+
+
+def synthetic_responses(n_players=1000, n_questions=10, changed=0.05, seed=0):
+    """
+    A responses dataframe like api_data_to_df makes, and the answers in the database it updates
+    :param changed: Fraction of answers whose response differs from the database
+    :return: responses, [(answer id, player email, question text, raw_string), ...]
+    """
+    rng = random.Random(seed)
+    q_texts = [f"Synthetic question {q}?" for q in range(n_questions)]
+    rows, prev_answers = [], []
+    for p in range(n_players):
+        email = f"player{p}@benchmark.benchmark"
+        answers = [rng.choice(SEED_ANSWERS) for _ in q_texts]
+        rows.append(["2021-11-25 10:00:00", email, f"Player {p}"] + answers)
+        for q_text, answer in zip(q_texts, answers):
+            raw_string = answer.upper() if rng.random() < changed else answer
+            prev_answers.append((len(prev_answers) + 1, email, q_text, raw_string))
+    responses = pd.DataFrame(rows, columns=["Timestamp", "Email Address", "Name"] + q_texts)
+    return responses, prev_answers
+
+
+def legacy_changed_answers(prev_answers, responses):
+    """The original update_answers_in_db diff, which scans the responses for the player of every answer"""
+    changes = []
+    for a_id, email, q_text, raw_string in prev_answers:
+        new_answer = responses.at[int(responses[responses["Email Address"] == email].index[0]), q_text]
+        if new_answer != raw_string:
+            changes.append((a_id, new_answer))
+    return changes
+
+
+def benchmark_changed_answers(player_counts=(250, 500, 1000, 2000), n_questions=10, repeat=1):
+    """
+    The legacy diff grows with players squared and the joined diff linearly, so the speedup should
+    roughly double with each doubling of players
+    :return: [{"players": n, "legacy_seconds": s, "joined_seconds": s, "speedup": x}, ...]
+    """
+    results = []
+    for n_players in player_counts:
+        responses, prev_answers = synthetic_responses(n_players, n_questions)
+        legacy = time_call(legacy_changed_answers, prev_answers, responses, repeat=repeat)
+        joined = time_call(changed_answers, prev_answers, responses, repeat=repeat)
+        results.append(
+            {"players": n_players, "legacy_seconds": legacy, "joined_seconds": joined, "speedup": legacy / joined}
+        )
+    return results
+
+
+def legacy_raw_answers_db_to_df(game):
+    """The original raw_answers_db_to_df, which walks the answers player by player"""
+    raw_player_answers = deque(
+        game.raw_player_answers.values_list(
+            "player__email",
+            "player__display_name",
+            "timestamp",
+            "question__text",
+            "raw_string",
+        )
+    )
+    qtext = [q_text for q_text in game.questions.values_list("text", flat=True).order_by("number")]
+
+    raw_answer_data = []
+    while raw_player_answers:
+        qt_cp = deepcopy(qtext)
+        (
+            p_id,
+            p_dn,
+            ts,
+            q_text,
+            ans,
+        ) = raw_player_answers[0]
+        ts = ts.astimezone(tz=timezone("US/Eastern"))
+        p_data = [ts.strftime("%m/%d/%Y %H:%M:%S"), p_id, p_dn]
+        this_p_id = p_id
+        while this_p_id == p_id and raw_player_answers:
+            next_q = qt_cp.pop(0)
+            *_, this_q, ans = raw_player_answers.popleft()
+            while this_q != next_q:
+                p_data.append(None)
+                next_q = qt_cp.pop(0)
+            p_data.append(ans)
+            if raw_player_answers:
+                this_p_id, *_ = raw_player_answers[0]
+        raw_answer_data.append(p_data + [""] * (3 + len(qtext) - len(p_data)))
+
+    raw_answers_df = pd.DataFrame(columns=["Timestamp", "Email Address", "Name"] + qtext, data=raw_answer_data)
+    return raw_answers_df.sort_values("Timestamp")
+
+
+def benchmark_raw_answers_db_to_df(game, repeat=3):
+    """Times building the responses frame of a game in the database, see leaderboard.benchmarks.create_synthetic_game"""
+    legacy = time_call(legacy_raw_answers_db_to_df, game, repeat=repeat)
+    pivoted = time_call(raw_answers_db_to_df, game, repeat=repeat)
+    return {"legacy_seconds": legacy, "pivoted_seconds": pivoted, "speedup": legacy / pivoted}
+
+
+def benchmark_responses_sync(game, latency=0.0, repeat=3):
+    """
+    Times syncing the responses sheet of a game in the database on the local sheets backend: rewriting
+    the whole sheet against appending the answers of the game's last player, which are deleted and
+    created again for every run
+    :param latency: Seconds each sheets call sleeps, to stand in for the Google Sheets API
+    """
+    from django.test import override_settings
+
+    last_answers = Answer.objects.filter(question__game=game).order_by("-id")
+    player_id = last_answers.values_list("player", flat=True).first()
+    rewrite_runs, append_runs = [], []
+    with override_settings(SHEETS_BACKEND="local", LOCAL_SHEETS_LATENCY=latency):
+        sheet_doc = get_sheet_doc(game)
+        for _ in range(repeat):
+            player_answers = list(Answer.objects.filter(question__game=game, player_id=player_id))
+            Answer.objects.filter(id__in=[a.id for a in player_answers]).delete()
+            clear_responses_sync([game])
+            rewrite_runs.extend(time_runs(sync_responses_sheet, game, sheet_doc, repeat=1))
+            for a in player_answers:
+                a.id = None
+            Answer.objects.bulk_create(player_answers)
+            append_runs.extend(time_runs(sync_responses_sheet, game, sheet_doc, repeat=1))
+    rewrite, append = min(rewrite_runs), min(append_runs)
+    return {"rewrite_seconds": rewrite, "append_seconds": append, "speedup": rewrite / append}
@@ -1,5 +1,7 @@
+import math
 import os
 import pickle
+import time
 
 import gspread
 import pandas as pd
@@ -9,9 +11,13 @@ from celery import shared_task
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from django.conf import settings
+from django.contrib.postgres.aggregates import StringAgg
+from django.db.models import CharField, Count, Func, Max, Q, Value
+from django.db.models.functions import Cast, Concat
 from project.utils import REDIS
 from game.models import Game
 from game.tasks import raw_answers_db_to_df
+from game.sheets import get_sheets_backend
 
 
 def get_or_create_gdrive_token():
@@ -42,12 +48,7 @@ def get_or_create_gdrive_token():
 
 
 def get_sheet_doc(game):
-    gc = gspread.service_account(settings.GOOGLE_GSPREAD_API_CONFIG)
-    try:
-        sheet_doc = gc.open(game.leaderboard.sheet_name)
-    except gspread.exceptions.SpreadsheetNotFound:
-        sheet_doc = gc.create(game.leaderboard.sheet_name, settings.GOOGLE_DRIVE_FOLDER_ID)
-    return sheet_doc
+    return get_sheets_backend().open(game.leaderboard.sheet_name)
 
 
 def api_data_to_df(raw_data):
@@ -111,6 +112,12 @@ def write_responses_sheet(sheet_doc, responses):
     sheet.update(writable_responses)
 
 
+def append_responses_sheet(sheet_doc, responses):
+    """Appends rows to the responses sheet in one call, raises WorksheetNotFound if there is no sheet yet"""
+    sheet = sheet_doc.worksheet("[auto] raw responses")
+    sheet.append_rows(responses.values.tolist())
+
+
 def build_rollups_and_tallies(answer_tally, answer_codes):
     return {k: (answer_tally[k], answer_codes[k]) for k in answer_tally.keys()}
 
@@ -188,16 +195,132 @@ def make_rollups_sheet(rollups_and_tallies):
     return sheet_data
 
 
-@shared_task
-def write_new_responses_to_gdrive(gid):
+@shared_task(bind=True, max_retries=3)
+def write_new_responses_to_gdrive(self, gid):
+    """
+    Syncs the responses sheet after a submission. One worker syncs a game at a time: submissions that
+    arrive meanwhile mark the game so the worker runs again, and syncs them all in one pass. Syncs of a
+    game are at least RESPONSES_SYNC_INTERVAL seconds apart, to stay under the Sheets API write quota:
+    a sync that comes too soon is scheduled for later rather than waited for, and one the API rate
+    limits (HTTP 429) is retried with a backoff, so the worker is free in the meantime.
+    """
+    pending_key = f"responses_pending_{gid}"
+    lock_key = f"responses_lock_{gid}"
+    REDIS.set(pending_key, "true", timeout=10 * 60)
     try:
         game = Game.objects.get(id=gid)
-        redis_key = f"responses_{game.series.slug}_{game.game_id}"
-        if REDIS.get(redis_key):
-            return
-        REDIS.set(redis_key, "true", timeout=60)
         sheet_doc = get_sheet_doc(game)
-        responses = raw_answers_db_to_df(game)
-        write_responses_sheet(sheet_doc, responses)
+        # a submission that marks the game after the last check but before the lock is released finds
+        # it locked, so the mark is checked again once the lock is gone
+        while REDIS.get(pending_key) and REDIS.add(lock_key, "true", timeout=10 * 60):
+            try:
+                while REDIS.get(pending_key):
+                    wait = seconds_until_responses_sync(gid)
+                    if wait > 0:
+                        # the marked game is synced by the scheduled run, one is enough
+                        if REDIS.add(f"responses_scheduled_{gid}", "true", timeout=math.ceil(wait)):
+                            write_new_responses_to_gdrive.apply_async((gid,), countdown=wait)
+                        return
+                    REDIS.delete(pending_key)
+                    try:
+                        sync_responses_sheet(game, sheet_doc)
+                    except gspread.exceptions.APIError as e:
+                        if getattr(e.response, "status_code", None) != 429:
+                            raise
+                        REDIS.set(pending_key, "true", timeout=10 * 60)
+                        raise self.retry(exc=e, countdown=10 * 2**self.request.retries)
+                    REDIS.set(f"responses_synced_at_{gid}", time.time(), timeout=60)
+            finally:
+                REDIS.delete(lock_key)
     except FileNotFoundError:
         print("Missing .config.gspread.commonology_service_account.json file.")
+
+
+def seconds_until_responses_sync(gid):
+    """:return: How long until RESPONSES_SYNC_INTERVAL seconds have passed since the game's last sync"""
+    synced_at = REDIS.get(f"responses_synced_at_{gid}")
+    if synced_at is None:
+        return 0
+    return synced_at + settings.RESPONSES_SYNC_INTERVAL - time.time()
+
+
+def responses_sync_key(game):
+    return f"responses_sync_{game.id}"
+
+
+def clear_responses_sync(games):
+    """The next sync of each game's responses sheet rewrites the whole sheet"""
+    REDIS.delete_many([responses_sync_key(g) for g in games])
+
+
+def answers_checksum(**kwargs):
+    """
+    An aggregate digest of the answers' raw strings and their players' emails and display names, in
+    answer id order, so an edit to a synced row changes it
+    :param kwargs: Passed to StringAgg, e.g. filter
+    """
+    row = Concat(
+        Cast("id", CharField()),
+        Value("\t"),
+        Cast("player__email", CharField()),
+        Value("\t"),
+        "player__display_name",
+        Value("\t"),
+        "raw_string",
+        output_field=CharField(),
+    )
+    return Func(StringAgg(row, "\n", ordering="id", **kwargs), function="MD5", output_field=CharField())
+
+
+def sync_responses_sheet(game, sheet_doc):
+    """
+    Brings the responses sheet up to date with the database. Players who answered since the last sync,
+    found by answer id, are appended. The whole sheet is rewritten on the first sync, and when synced
+    answers were removed or edited (see answers_checksum), answers arrived for synced players or the
+    questions changed.
+    :param game: The game object
+    :param sheet_doc: The game's spreadsheet
+    :return: True if the sheet was rewritten, False if rows were appended or nothing changed
+    """
+    key = responses_sync_key(game)
+    synced = REDIS.get(key)
+    last_synced_id = synced["last_answer_id"] if synced else 0
+    answers = game.raw_player_answers
+    synced_filter = Q(id__lte=last_synced_id)
+    counts = answers.aggregate(
+        last_answer_id=Max("id"),
+        answers=Count("id"),
+        synced=Count("id", filter=synced_filter),
+        checksum=answers_checksum(),
+        synced_checksum=answers_checksum(filter=synced_filter),
+    )
+    last_answer_id = counts["last_answer_id"] or 0
+    columns = list(game.questions.order_by("number").values_list("text", flat=True))
+    new_answers = answers.filter(id__gt=last_synced_id, id__lte=last_answer_id)
+
+    rewrite = (
+        not synced
+        or synced["columns"] != columns
+        or synced["answers"] != counts["synced"]
+        or synced.get("checksum") != counts["synced_checksum"]
+        or new_answers.filter(player__in=answers.filter(id__lte=last_synced_id).values("player")).exists()
+    )
+    if not rewrite and last_answer_id > last_synced_id:
+        try:
+            append_responses_sheet(sheet_doc, raw_answers_db_to_df(game, new_answers))
+        except gspread.exceptions.WorksheetNotFound:
+            rewrite = True
+    if rewrite:
+        write_responses_sheet(sheet_doc, raw_answers_db_to_df(game, answers.filter(id__lte=last_answer_id)))
+
+    REDIS.set(
+        key,
+        {
+            "last_answer_id": last_answer_id,
+            "answers": counts["answers"],
+            "checksum": counts["checksum"],
+            "columns": columns,
+        },
+        timeout=24 * 60 * 60,
+    )
+    return rewrite
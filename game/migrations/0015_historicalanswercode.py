@@ -0,0 +1,38 @@
+# Generated by Django 3.2.8 on 2026-10-18 12:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("game", "0014_auto_20211125_1001"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="HistoricalAnswerCode",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("question_key", models.CharField(max_length=32)),
+                ("question_text", models.CharField(max_length=10000)),
+                ("raw_string", models.CharField(max_length=1000)),
+                ("coded_answer", models.CharField(max_length=1000)),
+                (
+                    "game",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="+",
+                        to="game.game",
+                    ),
+                ),
+                ("updated", models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                "unique_together": {("question_key", "raw_string")},
+            },
+        ),
+    ]
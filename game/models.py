@@ -1,3 +1,4 @@
+import hashlib
 import uuid
 from bulk_update_or_create import BulkUpdateOrCreateQuerySet
 from django.db import models
@@ -287,3 +288,36 @@ class AnswerCode(models.Model):
     @property
     def game(self):
         return self.question.game
+
+
+class HistoricalAnswerCode(models.Model):
+    """
+    The coding of a raw string approved in an earlier game, so recurring questions start out with the
+    rollups humans already made. Question texts and raw strings are normalized (see normalize_text) and
+    the question is looked up by a digest of its text.
+    """
+
+    objects = BulkUpdateOrCreateQuerySet.as_manager()
+    question_key = models.CharField(max_length=32)
+    question_text = models.CharField(max_length=10000)
+    raw_string = models.CharField(max_length=1000)
+    coded_answer = models.CharField(max_length=1000)
+    game = models.ForeignKey(Game, null=True, blank=True, on_delete=models.SET_NULL, related_name="+")
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("question_key", "raw_string")
+
+    def __str__(self):
+        return self.coded_answer
+
+    def __repr__(self):
+        return f"{self.question_text}-{self.raw_string}"
+
+    @staticmethod
+    def normalize_text(text):
+        return " ".join(text.lower().split())
+
+    @classmethod
+    def key_for(cls, question_text):
+        return hashlib.blake2b(cls.normalize_text(question_text).encode(), digest_size=16).hexdigest()
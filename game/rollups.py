@@ -1,8 +1,35 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
 import gspread
+import numpy as np
 from fuzzywuzzy import fuzz
 from num2word import word
 
-from game.models import AnswerCode
+import django
+from django.conf import settings
+from django.db.models import Count, Exists, OuterRef
+
+from project.utils import REDIS, ANALYTICS_REDIS, our_now
+from game.models import Answer, AnswerCode, HistoricalAnswerCode
+from game.similarity import get_scorer
+
+AUTOCODE_MATCHER_TTL = 24 * 60 * 60
+LOCAL_MATCHER_CACHE_SIZE = 256
+_MATCHER_STAMP_PREFIX = "acstamp:"
+_local_matchers = OrderedDict()
+_local_matchers_lock = threading.Lock()
+LOCAL_AUTOCODE_CACHE_SIZE = 4096
+_local_autocodes = OrderedDict()
+AUTOCODE_CACHE_COUNTERS = ("local_hits", "redis_hits", "misses")
+autocode_cache_counts = Counter()
 
 
 def autorollup_question_answer(question, raw_player_answer):
@@ -15,30 +42,245 @@ def autorollup_question_answer(question, raw_player_answer):
         a. See if the raw_answer is "close_enough()" to the corresponding AnswerCode.raw_string (and return)
         b. Get the fuzzy ratio between the raw_answer and AnswerCode.raw_string and if it the best match
             so far, save it as the fallback code (and continue)
+
+    The work is done by the question's cached AutocodeMatcher (see question_autocode_matcher). Players
+    mostly type the same few answers, so answers it had to fuzzy match are remembered by this process
+    and in Redis, under the matcher's stamp so they're dropped with it when the AnswerCodes change.
+    They're remembered by the exact raw string, not its normalized form: the fuzz.ratio fallback is case
+    and space sensitive, and an answer nothing matches becomes a code of its own as typed, so answers
+    that only differ in case or spacing can get different codes.
     """
+    matcher = question_autocode_matcher(question)
+    if raw_player_answer in matcher.coded_answers:
+        return matcher.coded_answers[raw_player_answer]
+
+    local_key = (question.id, matcher.stamp, raw_player_answer)
+    with _local_matchers_lock:
+        if local_key in _local_autocodes:
+            _local_autocodes.move_to_end(local_key)
+            autocode_cache_counts["local_hits"] += 1
+            return _local_autocodes[local_key]
+
+    digest = hashlib.blake2b(raw_player_answer.encode(), digest_size=16).hexdigest()
+    redis_key = f"autocode_answer:{question.id}:{matcher.stamp}:{digest}"
+    coded_player_answer = REDIS.get(redis_key)
+    if coded_player_answer is None:
+        coded_player_answer = matcher.autocode(raw_player_answer)
+        REDIS.set(redis_key, coded_player_answer, AUTOCODE_MATCHER_TTL)
+        counter = "misses"
+    else:
+        counter = "redis_hits"
+
+    with _local_matchers_lock:
+        autocode_cache_counts[counter] += 1
+        _local_autocodes[local_key] = coded_player_answer
+        while len(_local_autocodes) > LOCAL_AUTOCODE_CACHE_SIZE:
+            _local_autocodes.popitem(last=False)
+    return coded_player_answer
+
+
+def clear_local_autocodes():
+    with _local_matchers_lock:
+        _local_autocodes.clear()
+
+
+def flush_autocode_cache_counts():
+    """Adds this process' autocode cache hits and misses to the totals in ANALYTICS_REDIS"""
+    with _local_matchers_lock:
+        counts = dict(autocode_cache_counts)
+        autocode_cache_counts.clear()
+    for counter, n in counts.items():
+        key = f"autocode_cache_{counter}"
+        try:
+            ANALYTICS_REDIS.incr(key, n)
+        except ValueError:
+            ANALYTICS_REDIS.set(key, n, timeout=None)
+
 
-    # all the codes from the live game
-    coded_answers = {ac.raw_string: ac.coded_answer for ac in question.coded_answers.all()}
-    coded_player_answer = raw_player_answer
+def autocode_cache_stats():
+    """:return: The total autocode cache hits and misses flushed by all processes"""
+    return {c: ANALYTICS_REDIS.get(f"autocode_cache_{c}") or 0 for c in AUTOCODE_CACHE_COUNTERS}
 
-    # we've seen this exact string before
-    if raw_player_answer in coded_answers:
-        coded_player_answer = coded_answers[raw_player_answer]
-        return coded_player_answer
 
-    # see if it's "close enough" to any string we've seen before
-    best_score = 0
-    for raw_string, coded_answer in coded_answers.items():
-        if close_enough(raw_player_answer, raw_string, []):
-            coded_player_answer = coded_answer
-            return coded_player_answer
+class AutocodeMatcher:
+    """
+    The AnswerCodes of one question, indexed so autorollup_question_answer doesn't scan all of them:
+        - an exact raw string is a dict lookup
+        - close_enough() is only tried on the raw strings a RollupIndex shortlists, in order
+        - fuzz.ratio is at most 2 * shared / (len(a) + len(b)), where shared is bounded from above
+          by character count signatures, so raw strings are scored best bound first and scoring
+          stops once no bound can reach the best ratio so far
+    It returns the same code as trying every AnswerCode in order.
+    """
+
+    # raw strings scored by the fuzz.ratio fallback per batch
+    ratio_batch_size = 32
+
+    def __init__(self, coded_answers, scorer=None):
+        """
+        :param coded_answers: {raw_string: coded_answer}, in the order AnswerCodes are tried
+        :param scorer: The name of the similarity backend (see game.similarity)
+        """
+        self.coded_answers = coded_answers
+        self.scorer = scorer
+        self.raw_strings = list(coded_answers)
+        # the stamp it's cached under, so answers it coded can be dropped with it
+        self.stamp = None
+        self._index = self._build_index()
+        bins = RollupIndex.signature_bins
+        self._lengths = np.array([len(r) for r in self.raw_strings], dtype="int64")
+        self._signatures = np.array([_char_signature(r, bins) for r in self.raw_strings], dtype="uint16")
+        self._signatures = self._signatures.reshape(len(self.raw_strings), bins)
+
+    def __getstate__(self):
+        # the RollupIndex holds its own signatures, it's rebuilt on load rather than cached twice
+        state = self.__dict__.copy()
+        del state["_index"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._index = self._build_index()
+
+    def _build_index(self):
+        index = RollupIndex({})
+        for raw_string in self.raw_strings:
+            index.add(raw_string)
+        return index
+
+    @classmethod
+    def from_question(cls, question):
+        return cls({ac.raw_string: ac.coded_answer for ac in question.coded_answers.all()})
+
+    def autocode(self, raw_player_answer):
+        # we've seen this exact string before
+        if raw_player_answer in self.coded_answers:
+            return self.coded_answers[raw_player_answer]
+
+        # see if it's "close enough" to any string we've seen before
+        player_answer = NormalizedAnswer(raw_player_answer)
+        candidates = self._index.candidates(player_answer)
+        matches = close_enough_many(player_answer, candidates, [], self.scorer)
+        if matches.any():
+            return self.coded_answers[candidates[int(matches.argmax())].raw]
 
         # finally find the string it's closest to, within reason
-        if (score := fuzz.ratio(raw_player_answer, raw_string)) > best_score:
-            best_score = score
-            coded_player_answer = coded_answer
+        position = self._best_ratio(raw_player_answer)
+        if position is None:
+            return raw_player_answer
+        return self.coded_answers[self.raw_strings[position]]
+
+    def _best_ratio(self, raw_player_answer):
+        """:return: The position of the first raw string with the highest (non zero) fuzz.ratio, or None"""
+        if not self.raw_strings:
+            return None
+        signature = _char_signature(raw_player_answer, RollupIndex.signature_bins)
+        shared = np.minimum(self._signatures, signature).sum(axis=1, dtype="int64")
+        total = np.maximum(self._lengths + len(raw_player_answer), 1)
+        bounds = np.ceil(200 * shared / total)
+        order = np.lexsort((np.arange(len(bounds)), -bounds))
+        scorer = get_scorer(self.scorer)
+        best_score, best_position = 0, None
+        batch_size = self.ratio_batch_size
+        for start in range(0, len(order), batch_size):
+            end = start + batch_size
+            batch = order[start:end]
+            batch = batch[bounds[batch] >= max(best_score, 1)]
+            if not len(batch):
+                break
+            scores = scorer.ratio(raw_player_answer, [self.raw_strings[p] for p in batch])
+            for position, score in zip(batch.tolist(), scores.tolist()):
+                is_first_best = score == best_score and best_position is not None and position < best_position
+                if score > best_score or is_first_best:
+                    best_score, best_position = score, position
+        return best_position
+
+
+def autocode_matcher_key(question):
+    return f"autocode_matcher:{question.id}"
+
+
+def cache_autocode_matcher(question):
+    """
+    Builds the question's AutocodeMatcher and shares it with every worker through Redis, under a
+    new stamp so copies other processes hold are dropped (see leaderboard.cache for the scheme)
+    """
+    matcher = AutocodeMatcher.from_question(question)
+    key = autocode_matcher_key(question)
+    stamp = _MATCHER_STAMP_PREFIX + uuid.uuid4().hex
+    REDIS.set_many({f"{key}:data": matcher, key: stamp}, AUTOCODE_MATCHER_TTL)
+    return _remember_matcher(key, stamp, matcher)
+
+
+def cache_autocode_matchers(game):
+    for question in game.questions.prefetch_related("coded_answers"):
+        cache_autocode_matcher(question)
 
-    return coded_player_answer
+
+def question_autocode_matcher(question):
+    """:return: The question's AutocodeMatcher from this process, Redis or (if neither has it) the database"""
+    key = autocode_matcher_key(question)
+    stamp = REDIS.get(key)
+    if not stamp:
+        return cache_autocode_matcher(question)
+
+    with _local_matchers_lock:
+        local = _local_matchers.get(key)
+        if local is not None and local[0] == stamp:
+            _local_matchers.move_to_end(key)
+            return local[1]
+
+    matcher = REDIS.get(f"{key}:data")
+    if matcher is None:
+        return cache_autocode_matcher(question)
+    return _remember_matcher(key, stamp, matcher)
+
+
+def clear_autocode_matchers(questions):
+    keys = [autocode_matcher_key(q) for q in questions]
+    if keys:
+        REDIS.delete_many(keys)
+
+
+def _remember_matcher(key, stamp, matcher):
+    matcher.stamp = stamp
+    with _local_matchers_lock:
+        _local_matchers[key] = (stamp, matcher)
+        _local_matchers.move_to_end(key)
+        while len(_local_matchers) > LOCAL_MATCHER_CACHE_SIZE:
+            _local_matchers.popitem(last=False)
+    return matcher
+
+
+class NormalizedAnswer:
+    """
+    An answer string with everything close_enough() compares worked out once: the lowercase and
+    stripped text, its length, whether it's an integer, its spelled out number form and a character
+    count signature (used by RollupIndex)
+    """
+
+    __slots__ = ("raw", "text", "length", "is_int", "number_word", "_signature")
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.text = raw.lower().strip()
+        self.length = len(self.text)
+        self.is_int = _is_int(self.text)
+        self.number_word = _number_word(self.text)
+        self._signature = None
+
+    def __repr__(self):
+        return f"NormalizedAnswer({self.raw!r})"
+
+    @property
+    def signature(self):
+        if self._signature is None:
+            self._signature = _char_signature(self.text, RollupIndex.signature_bins)
+        return self._signature
+
+
+def normalized(answer):
+    return answer if isinstance(answer, NormalizedAnswer) else NormalizedAnswer(answer)
 
 
 def close_enough(answer, potential_match, context_synonyms):
@@ -49,64 +291,96 @@ def close_enough(answer, potential_match, context_synonyms):
         - context synonyms (user override)
         - small typos (see fuzz section for rules)
         - spelling out numbers (e.g. 4 and four)
-    :param answer: the answer in question
-    :param potential_match: a potential match for that word
+    :param answer: the answer in question, a string or NormalizedAnswer
+    :param potential_match: a potential match for that word, a string or NormalizedAnswer
     :param context_synonyms: a dictionary of potential matches mapped to answers
     :return: Bool
     """
 
-    answer = answer.lower().strip()
-    potential_match = potential_match.lower().strip()
+    answer = normalized(answer)
+    potential_match = normalized(potential_match)
 
     # an exact match
-    if potential_match == answer:
+    if potential_match.text == answer.text:
         return True
 
     # it's a context synonym (user override)
-    if potential_match in context_synonyms:
-        if context_synonyms[potential_match].lower().strip() == answer.lower():
+    if potential_match.text in context_synonyms:
+        if context_synonyms[potential_match.text].lower().strip() == answer.text:
             return True
 
     # integers must be an exact match
-    try:
-        int(potential_match)
+    if potential_match.is_int:
         return False
-    except ValueError:
-        pass
 
     # it's a typo, slightly different, or shortened version (where both strings are 6 or more characters)
     # or if it's a short string, it is a complete subset and has a full ratio greater than 50
-    if all(
-        (fuzz.partial_ratio(answer.lower(), potential_match.lower()) > 70, len(answer) > 5, len(potential_match) > 5)
-    ) or all(
-        (fuzz.partial_ratio(answer.lower(), potential_match.lower()) == 100, fuzz.ratio(answer, potential_match) > 50)
+    partial_ratio = fuzz.partial_ratio(answer.text, potential_match.text)
+    if all((partial_ratio > 70, answer.length > 5, potential_match.length > 5)) or all(
+        (partial_ratio == 100, fuzz.ratio(answer.text, potential_match.text) > 50)
     ):
         return True
 
     # it's like "four" instead of "4"
-    else:
-        try:
-            if word(answer).lower() == potential_match.lower():
-                return True
-        except Exception:
-            pass
+    return answer.number_word == potential_match.text
 
-    return False
 
-
-def process_rollups(col_name, raw_counts, user_rollups):
+def close_enough_many(answer, potential_matches, context_synonyms, scorer=None, stats=None):
+    """
+    close_enough() of answer against each of potential_matches, with the fuzzy ratios of all of them
+    scored in one call to the similarity backend
+    :param potential_matches: A list of NormalizedAnswers
+    :param scorer: The name of the similarity backend (see game.similarity)
+    :param stats: A Counter of close_enough calls and fuzzy comparisons to add to
+    :return: A boolean array, True where close_enough() is
+    """
+    answer = normalized(answer)
+    matches = np.zeros(len(potential_matches), dtype=bool)
+    fuzzy = []
+    for i, potential_match in enumerate(potential_matches):
+        if potential_match.text == answer.text:
+            matches[i] = True
+        elif (
+            potential_match.text in context_synonyms
+            and context_synonyms[potential_match.text].lower().strip() == answer.text
+        ):
+            matches[i] = True
+        elif not potential_match.is_int:
+            fuzzy.append(i)
+    if stats is not None:
+        stats["close_enough_calls"] += len(potential_matches)
+        stats["fuzzy_comparisons"] += len(fuzzy)
+    if not fuzzy:
+        return matches
+
+    scorer = get_scorer(scorer)
+    texts = [potential_matches[i].text for i in fuzzy]
+    lengths = np.array([potential_matches[i].length for i in fuzzy])
+    partial_ratios = scorer.partial_ratio(answer.text, texts)
+    is_match = (partial_ratios > 70) & (answer.length > 5) & (lengths > 5)
+    subsets = np.flatnonzero(partial_ratios == 100)
+    if len(subsets):
+        is_match[subsets] |= scorer.ratio(answer.text, [texts[i] for i in subsets]) > 50
+    if answer.number_word is not None:
+        is_match |= np.array([text == answer.number_word for text in texts])
+    matches[fuzzy] = is_match
+    return matches
+
+
+def process_rollups(col_name, raw_counts, user_rollups, scorer=None, stats=None):
     """
     The engine behind helpful auto-coding for answers not approved by a human.
     Looks for an existing rollup the answer most likely belongs to, and creates
     a new one if it cannot find one.
+    :param scorer: The name of the similarity backend (see game.similarity)
+    :param stats: A Counter of unique responses, rollup hits, close_enough calls and fuzzy comparisons to add to
     """
     rollups = user_rollups.get(col_name, [])
     updated_counts = {}
     processed_rollups = {}
+    rollup_index = RollupIndex(rollups)
     resolved = {}
-    for unique_resp, count in (
-        raw_counts.sort_index(axis=0, ascending=False).sort_values(axis=0, ascending=False).items()
-    ):
+    for unique_resp, count in _by_count(raw_counts).items():
 
         # this answer was merged into a larger answer
         if unique_resp not in resolved:
@@ -114,8 +388,13 @@ def process_rollups(col_name, raw_counts, user_rollups):
         else:
             continue
 
+        if stats is not None:
+            stats["unique_responses"] += 1
+
         # get the coding from the rollups sheet if it exists and go to next unique response
         if unique_resp in rollups:
+            if stats is not None:
+                stats["rollup_hits"] += 1
             recode_val = rollups[unique_resp]
             if recode_val in updated_counts:
                 updated_counts[recode_val] += count
@@ -123,49 +402,365 @@ def process_rollups(col_name, raw_counts, user_rollups):
             else:
                 updated_counts[recode_val] = count
                 processed_rollups[recode_val] = [unique_resp]
+                rollup_index.add(recode_val)
             continue
 
         # this unique response doesn't have a coding associated in the Google Sheet
         # let's see if it seems like a match to an existing rollup
-        is_merged = False
-        for rollup_name in list(processed_rollups.keys()):
-            if close_enough(unique_resp, rollup_name, rollups):
-                is_merged = True
-                recode_val = rollup_name
-                if recode_val in updated_counts:
-                    updated_counts[recode_val] += count
-                    processed_rollups[recode_val].append(unique_resp)
-                else:
-                    updated_counts[recode_val] = count
-                    processed_rollups[recode_val] = [unique_resp]
-                break
-
-        if is_merged:
+        response = NormalizedAnswer(unique_resp)
+        candidates = rollup_index.candidates(response)
+        matches = close_enough_many(response, candidates, rollups, scorer, stats)
+        if matches.any():
+            recode_val = candidates[int(matches.argmax())].raw
+            if recode_val in updated_counts:
+                updated_counts[recode_val] += count
+                processed_rollups[recode_val].append(unique_resp)
+            else:
+                updated_counts[recode_val] = count
+                processed_rollups[recode_val] = [unique_resp]
             continue
 
         # this unique response has not been coded and doesn't look like anything we've seen
         # so we make it its own category
         processed_rollups[unique_resp] = [unique_resp]
         updated_counts[unique_resp] = count
+        rollup_index.add(unique_resp)
 
     return updated_counts, processed_rollups
 
 
+def _by_count(raw_counts):
+    """The order process_rollups codes raw strings in, so the most common string of a rollup names it"""
+    return raw_counts.sort_index(axis=0, ascending=False).sort_values(axis=0, ascending=False)
+
+
+class RollupIndex:
+    """
+    Shortlists the rollups an answer could be close_enough() to, in the order they were added, so
+    process_rollups only fuzzy matches a handful of rollups instead of all of them. The shortlist
+    never drops a rollup close_enough() would accept:
+        - exact, context synonym and spelled out number matches are looked up in hash buckets
+        - the fuzzy rules need a partial_ratio of 70 (strings over 5 characters) or 100, which
+          bounds the characters the two strings must share. Shared characters are bounded from
+          above with per-string character count signatures, checked against all rollups at once.
+        - integer rollups only ever match exactly (or by synonym), so they skip the fuzzy check
+    """
+
+    signature_bins = 128
+
+    def __init__(self, context_synonyms):
+        self.context_synonyms = context_synonyms
+        self.rollups = []
+        self._by_text = defaultdict(list)
+        self._by_synonym = defaultdict(list)
+        self._fuzzy_positions = np.empty(16, dtype="int64")
+        self._lengths = np.empty(16, dtype="int64")
+        self._signatures = np.empty((16, self.signature_bins), dtype="uint16")
+        self._n_fuzzy = 0
+
+    def add(self, rollup_name):
+        rollup = normalized(rollup_name)
+        position = len(self.rollups)
+        self.rollups.append(rollup)
+        self._by_text[rollup.text].append(position)
+        if rollup.text in self.context_synonyms:
+            self._by_synonym[self.context_synonyms[rollup.text].lower().strip()].append(position)
+        if not rollup.is_int:
+            self._add_fuzzy(position, rollup)
+
+    def candidates(self, answer):
+        """:return: The NormalizedAnswers of the rollups answer might be close enough to, in the order added"""
+        answer = normalized(answer)
+        positions = set(self._by_text.get(answer.text, ()))
+        positions.update(self._by_synonym.get(answer.text, ()))
+        if answer.number_word is not None:
+            positions.update(self._by_text.get(answer.number_word, ()))
+        if answer.length and self._n_fuzzy:
+            positions.update(self._fuzzy_candidates(answer).tolist())
+        return [self.rollups[p] for p in sorted(positions)]
+
+    def _add_fuzzy(self, position, rollup):
+        if self._n_fuzzy == len(self._lengths):
+            self._fuzzy_positions = np.resize(self._fuzzy_positions, 2 * self._n_fuzzy)
+            self._lengths = np.resize(self._lengths, 2 * self._n_fuzzy)
+            self._signatures = np.resize(self._signatures, (2 * self._n_fuzzy, self.signature_bins))
+        self._fuzzy_positions[self._n_fuzzy] = position
+        self._lengths[self._n_fuzzy] = rollup.length
+        self._signatures[self._n_fuzzy] = rollup.signature
+        self._n_fuzzy += 1
+
+    def _fuzzy_candidates(self, answer):
+        n = self._n_fuzzy
+        lengths = self._lengths[:n]
+        shared = np.minimum(self._signatures[:n], answer.signature).sum(axis=1, dtype="int64")
+        shorter = np.minimum(lengths, answer.length)
+        # a ratio over the shorter string is at most 2 * shared / (shorter + shared)
+        typo = (answer.length > 5) & (lengths > 5) & (13 * shared >= 7 * shorter)
+        subset = (101 * shared >= 99 * shorter) & (4 * shared >= lengths + answer.length)
+        return self._fuzzy_positions[:n][typo | subset]
+
+
+def _is_int(text):
+    try:
+        int(text)
+        return True
+    except ValueError:
+        return False
+
+
+def _number_word(text):
+    try:
+        return word(text).lower()
+    except Exception:
+        return None
+
+
+def _char_signature(text, bins):
+    code_points = np.frombuffer(text.encode("utf-32-le"), dtype="<u4")
+    return np.bincount(code_points % bins, minlength=bins).astype("uint16")
+
+
 # all the merged answers, with auto codes where needed
-def build_answer_codes(df, rollups_dict):
-    answer_codes = {}
-    optional_cols = [c for c in df.columns if c.startswith("OPTIONAL: ")]
-    for col in df.iloc[:, 3:]:
-        counts = df[col].value_counts()
-        _, col_answer_codes = process_rollups(col, counts, rollups_dict)
-        answer_codes[col] = col_answer_codes
-    return answer_codes
+def build_answer_codes(df, rollups_dict, workers=1, history=False, scorer=None, profile=None):
+    """
+    :param scorer: The name of the similarity backend (see game.similarity)
+    :param profile: A list to add each question's rollup profile to (see profile_process_rollups)
+    :param history: Code raw strings approved in earlier games for the same question (see
+        with_historical_rollups) before fuzzy matching the rest
+    :param workers: Questions are independent, so with more than one worker each question's
+        process_rollups runs in a pool of that many spawned processes. Daemonic processes (e.g. celery's
+        prefork workers) can't have children, so there it always runs serially.
+    :return: The processed rollups of each question, keyed (and ordered) by question column
+    """
+    cols = list(df.columns[3:])
+    if history:
+        rollups_dict = with_historical_rollups(df, rollups_dict)
+    # resolved here, spawned workers don't see settings overridden in this process
+    scorer = scorer or settings.ROLLUP_SCORER
+    args = [(col, df[col].value_counts(), {col: rollups_dict.get(col, {})}, scorer) for col in cols]
+    workers = min(workers, len(cols))
+    if workers > 1 and not multiprocessing.current_process().daemon:
+        # spawn rather than fork, a forked copy of a threaded web worker can deadlock on a lock held by
+        # another thread. Spawned workers start a fresh interpreter, so they set up django first.
+        mp_context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(workers, mp_context=mp_context, initializer=django.setup) as executor:
+            results = list(executor.map(profile_process_rollups, *zip(*args)))
+    else:
+        results = [profile_process_rollups(*a) for a in args]
+    if profile is not None:
+        profile.extend(question_profile for _, question_profile in results)
+    return {col: col_answer_codes for col, (col_answer_codes, _) in zip(cols, results)}
+
+
+def profile_process_rollups(col_name, raw_counts, user_rollups, scorer=None):
+    """
+    :return: The processed rollups of the question and its profile: the number of unique responses,
+        how many of them the rollups coded, close_enough calls, fuzzy comparisons and wall time
+    """
+    stats = Counter()
+    start = time.perf_counter()
+    _, processed_rollups = process_rollups(col_name, raw_counts, user_rollups, scorer, stats)
+    question_profile = {
+        "question": col_name,
+        "unique_responses": stats["unique_responses"],
+        "rollup_hits": stats["rollup_hits"],
+        "close_enough_calls": stats["close_enough_calls"],
+        "fuzzy_comparisons": stats["fuzzy_comparisons"],
+        "seconds": round(time.perf_counter() - start, 4),
+    }
+    return processed_rollups, question_profile
+
+
+def rollup_profile_summary(profile, n=3):
+    """:return: A one line summary of a game's rollup profile, naming its n slowest questions"""
+    total = sum(p["seconds"] for p in profile)
+    slowest = sorted(profile, key=lambda p: -p["seconds"])[:n]
+    questions = "; ".join(
+        f"{p['question'][:50]} ({p['seconds']:.2f}s, {p['unique_responses']} unique, "
+        f"{p['fuzzy_comparisons']} fuzzy comparisons)"
+        for p in slowest
+    )
+    return f"Coding answers took {total:.2f}s. Slowest questions: {questions}"
+
+
+def write_rollup_profile(game, profile):
+    """Writes a game's rollup profile as JSON to ROLLUP_PROFILE_ROOT and returns the file path"""
+    os.makedirs(settings.ROLLUP_PROFILE_ROOT, exist_ok=True)
+    fn = os.path.join(settings.ROLLUP_PROFILE_ROOT, f"{game.series.slug}_{game.game_id}.json")
+    with open(fn, "w") as fh:
+        json.dump({"game": game.name, "tabulated": our_now().isoformat(), "questions": profile}, fh, indent=2)
+    return fn
+
+
+def historical_rollups(question_texts):
+    """:return: {question_text: {normalized raw string: coded answer}} approved in earlier games"""
+    keys = {HistoricalAnswerCode.key_for(q_text): q_text for q_text in question_texts}
+    known = {q_text: {} for q_text in question_texts}
+    codes = HistoricalAnswerCode.objects.filter(question_key__in=keys).values_list(
+        "question_key", "raw_string", "coded_answer"
+    )
+    for key, raw_string, coded_answer in codes:
+        known[keys[key]][raw_string] = coded_answer
+    return known
+
+
+def with_historical_rollups(df, rollups_dict):
+    """
+    Adds the codes of raw strings approved in earlier games to the rollups of each question, so
+    process_rollups looks them up instead of fuzzy matching them. The rollups sheet takes precedence.
+    """
+    cols = list(df.columns[3:])
+    known = historical_rollups(cols)
+    merged = dict(rollups_dict)
+    for col in cols:
+        if not known[col]:
+            continue
+        col_rollups = dict(rollups_dict.get(col, {}))
+        for raw_string in df[col].dropna().unique():
+            if raw_string in col_rollups:
+                continue
+            coded_answer = known[col].get(HistoricalAnswerCode.normalize_text(raw_string))
+            if coded_answer:
+                col_rollups[raw_string] = coded_answer
+        merged[col] = col_rollups
+    return merged
+
+
+def learn_rollups(game, rollups_dict):
+    """
+    Saves human approved codings ({question_text: {raw_string: coded_answer}}) for later games with
+    the same questions
+    """
+    codes = {}
+    for q_text, codings in rollups_dict.items():
+        key = HistoricalAnswerCode.key_for(q_text)
+        for raw_string, coded_answer in codings.items():
+            if coded_answer:
+                raw_string = HistoricalAnswerCode.normalize_text(raw_string)
+                codes[(key, raw_string)] = HistoricalAnswerCode(
+                    question_key=key, question_text=q_text, raw_string=raw_string, coded_answer=coded_answer, game=game
+                )
+    if codes:
+        HistoricalAnswerCode.objects.bulk_update_or_create(
+            list(codes.values()), ["question_text", "coded_answer", "game"], match_field=("question_key", "raw_string")
+        )
+
+
+def edited_rollups(game, rollups_dict):
+    """
+    The rollups sheet is rewritten with every code after each tabulation, auto codes included, so only the
+    codings that differ from the game's AnswerCodes were made by a human
+    :return: The edited codings of rollups_dict, {question_text: {raw_string: coded_answer}}
+    """
+    coded = defaultdict(dict)
+    for q_text, raw_string, coded_answer in AnswerCode.objects.filter(question__game=game).values_list(
+        "question__text", "raw_string", "coded_answer"
+    ):
+        coded[q_text][raw_string] = coded_answer
+    edited = {}
+    for q_text, codings in rollups_dict.items():
+        q_coded = coded.get(q_text, {})
+        q_edited = {raw: code for raw, code in codings.items() if code and q_coded.get(raw) != code}
+        if q_edited:
+            edited[q_text] = q_edited
+    return edited
+
+
+def with_streamed_rollups(game, df, rollups_dict):
+    """
+    Adds the game's AnswerCodes so far, most of them coded by code_new_answers as answers were submitted,
+    to the rollups of each question, so build_answer_codes only fuzzy matches the strings without a code.
+    Streamed codes are picked one string at a time, so a code that is one of its own raw strings is
+    renamed to the group's most common string, the way process_rollups names it. Codes approved in an
+    earlier game keep their name. The rollups sheet takes precedence.
+    :param df: The responses being tabulated
+    :return: rollups_dict with the streamed groupings added
+    """
+    groups = defaultdict(lambda: defaultdict(list))
+    for q_text, raw_string, coded_answer in AnswerCode.objects.filter(question__game=game).values_list(
+        "question__text", "raw_string", "coded_answer"
+    ):
+        groups[q_text][coded_answer].append(raw_string)
+    cols = [col for col in df.columns[3:] if col in groups]
+    known = historical_rollups(cols)
+
+    merged = dict(rollups_dict)
+    for col in cols:
+        rank = {raw_string: i for i, raw_string in enumerate(_by_count(df[col].value_counts()).index)}
+        col_rollups = {}
+        for coded_answer, raw_strings in groups[col].items():
+            approved = any(known[col].get(HistoricalAnswerCode.normalize_text(r)) == coded_answer for r in raw_strings)
+            ranked = [r for r in raw_strings if r in rank]
+            if coded_answer in raw_strings and ranked and not approved:
+                coded_answer = min(ranked, key=rank.get)
+            col_rollups.update((raw_string, coded_answer) for raw_string in raw_strings)
+        col_rollups.update(rollups_dict.get(col, {}))
+        merged[col] = col_rollups
+    return merged
+
+
+def code_new_answers(game):
+    """
+    Codes the raw strings of a live game that don't have an AnswerCode yet, as they're submitted, so
+    tabulate_results only has to fuzzy match the strings that arrived since (see with_streamed_rollups).
+    Each question's AnswerCodes are its rollup state: a new string takes the code approved in an earlier game, else
+    the first code it's close_enough() to, else becomes a code of its own.
+    :return: The number of AnswerCodes created
+    """
+    has_code = AnswerCode.objects.filter(question=OuterRef("question"), raw_string=OuterRef("raw_string"))
+    new_raw_counts = (
+        Answer.objects.filter(question__game=game, removed=False)
+        .annotate(has_code=Exists(has_code))
+        .filter(has_code=False)
+        .values("question_id", "raw_string")
+        .annotate(count=Count("id"))
+        .order_by("question_id", "-count", "raw_string")
+    )
+    new_raw_strings = defaultdict(list)
+    for row in new_raw_counts:
+        new_raw_strings[row["question_id"]].append(row["raw_string"])
+    if not new_raw_strings:
+        return 0
+
+    questions = game.questions.filter(id__in=new_raw_strings)
+    known = historical_rollups([q.text for q in questions])
+    answer_codes = []
+    for question in questions:
+        coded_answers = dict(question.coded_answers.order_by("id").values_list("raw_string", "coded_answer"))
+        rollup_index = RollupIndex(coded_answers)
+        for coded_answer in dict.fromkeys(coded_answers.values()):
+            rollup_index.add(coded_answer)
+        for raw_string in new_raw_strings[question.id]:
+            coded_answer = known[question.text].get(HistoricalAnswerCode.normalize_text(raw_string))
+            if coded_answer is None:
+                response = NormalizedAnswer(raw_string)
+                candidates = rollup_index.candidates(response)
+                matches = close_enough_many(response, candidates, coded_answers)
+                if matches.any():
+                    coded_answer = candidates[int(matches.argmax())].raw
+            if coded_answer is None:
+                coded_answer = raw_string
+                rollup_index.add(coded_answer)
+            answer_codes.append(AnswerCode(question=question, raw_string=raw_string, coded_answer=coded_answer))
+
+    # tabulate_results may have coded some of them in the meantime, its codes win
+    AnswerCode.objects.bulk_create(answer_codes, ignore_conflicts=True)
+    return len(answer_codes)
 
 
 def answer_merges(game):
+    """
+    :return: {question_text: {coded_answer: [raw_string, ...]}} for every question of the game, in
+        question order, from one query of the questions joined to their AnswerCodes
+    """
+    rows = game.questions.order_by("number", "coded_answers__id").values_list(
+        "text", "coded_answers__coded_answer", "coded_answers__raw_string"
+    )
     game_merges = {}
-    for q_text in game.questions.values_list("text", flat=True):
-        game_merges[q_text] = question_merges(game, q_text)
+    for q_text, coded_answer, raw_string in rows:
+        q_merges = game_merges.setdefault(q_text, {})
+        if coded_answer is not None:
+            q_merges.setdefault(coded_answer, []).append(raw_string)
     return game_merges
 
 
@@ -0,0 +1,186 @@
+"""
+Spreadsheet backends for tabulation: Google Sheets through gspread, or local sheets for offline runs.
+"""
+
+import json
+import os
+import threading
+import time
+
+import gspread
+from django.conf import settings
+from gspread.utils import a1_to_rowcol
+
+
+class GspreadBackend:
+    name = "gspread"
+
+    def open(self, title):
+        gc = gspread.service_account(settings.GOOGLE_GSPREAD_API_CONFIG)
+        try:
+            return gc.open(title)
+        except gspread.exceptions.SpreadsheetNotFound:
+            return gc.create(title, settings.GOOGLE_DRIVE_FOLDER_ID)
+
+
+class LocalBackend:
+    name = "local"
+
+    def __init__(self):
+        self.docs = {}
+        self._lock = threading.Lock()
+
+    def open(self, title):
+        root = settings.LOCAL_SHEETS_ROOT
+        with self._lock:
+            if title not in self.docs:
+                self.docs[title] = LocalSpreadsheet(title, root=root)
+            return self.docs[title]
+
+    def clear(self):
+        """Forgets the spreadsheets in memory, files in settings.LOCAL_SHEETS_ROOT are left alone"""
+        with self._lock:
+            self.docs.clear()
+
+
+class LocalAPIError(gspread.exceptions.APIError):
+    def __init__(self, message):
+        gspread.exceptions.GSpreadException.__init__(self, message)
+        self.response = None
+
+
+class LocalSpreadsheet:
+    def __init__(self, title, root=None):
+        self.title = title
+        self.path = os.path.join(root, f"{title}.json") if root else None
+        self._worksheets = {}
+        if self.path and os.path.exists(self.path):
+            with open(self.path) as f:
+                for ws_title, ws in json.load(f).items():
+                    self._worksheets[ws_title] = LocalWorksheet(self, ws_title, ws["rows"], ws["cols"], ws["values"])
+
+    def worksheet(self, title):
+        self.wait()
+        try:
+            return self._worksheets[title]
+        except KeyError:
+            raise gspread.exceptions.WorksheetNotFound(title)
+
+    def worksheets(self):
+        self.wait()
+        return list(self._worksheets.values())
+
+    def add_worksheet(self, title, rows, cols, index=None):
+        self.wait()
+        if title in self._worksheets:
+            raise LocalAPIError(f'A sheet with the name "{title}" already exists. Please enter another name.')
+        self._worksheets[title] = LocalWorksheet(self, title, rows, cols)
+        self.save()
+        return self._worksheets[title]
+
+    def values_get(self, range, params=None):
+        """
+        Reads a whole worksheet, like the API: cells come back as strings and trailing empty cells and
+        rows are left out, so an empty worksheet has no values
+        :param range: The worksheet title, A1 ranges within it are not supported
+        :param params: {"major_dimension": "ROWS"} or "COLUMNS"
+        """
+        title = range.strip("'")
+        values = self.worksheet(title).get_values()
+        params = params or {}
+        major_dimension = params.get("major_dimension") or params.get("majorDimension") or "ROWS"
+        if major_dimension == "COLUMNS":
+            values = _trim(_transpose(values, ""))
+        response = {"range": title, "majorDimension": major_dimension}
+        if values:
+            response["values"] = values
+        return response
+
+    def wait(self):
+        """Stands in for the round trip of an API call"""
+        latency = settings.LOCAL_SHEETS_LATENCY
+        if latency:
+            time.sleep(latency)
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        data = {
+            ws.title: {"rows": ws.row_count, "cols": ws.col_count, "values": ws.values}
+            for ws in self._worksheets.values()
+        }
+        with open(self.path, "w") as f:
+            json.dump(data, f, default=str)
+
+
+class LocalWorksheet:
+    def __init__(self, spreadsheet, title, rows, cols, values=None):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.row_count = rows
+        self.col_count = cols
+        self.values = values or []
+
+    def get_values(self):
+        """:return: The cells as strings, without trailing empty cells and rows"""
+        return _trim([["" if v is None else str(v) for v in row] for row in self.values])
+
+    def update(self, range_name, values=None, major_dimension=None, **kwargs):
+        """Writes values from the top left cell of range_name, A1 when only values are given"""
+        self.spreadsheet.wait()
+        if values is None:
+            values, range_name = range_name, "A1"
+        if not isinstance(values, list):
+            values = [[values]]
+        if major_dimension == "COLUMNS":
+            values = _transpose(values, None)
+        row, col = a1_to_rowcol(range_name.split(":")[0])
+        self._write(row - 1, col - 1, values)
+        self.spreadsheet.save()
+
+    def append_rows(self, values, **kwargs):
+        """Writes rows after the last row with a value"""
+        self.spreadsheet.wait()
+        self._write(len(self.get_values()), 0, values)
+        self.spreadsheet.save()
+
+    def clear(self):
+        self.spreadsheet.wait()
+        self.values = []
+        self.spreadsheet.save()
+
+    def _write(self, row, col, values):
+        # writes past the edge of the sheet grow it, which the API does for appends only
+        for r, row_values in enumerate(values, row):
+            while len(self.values) <= r:
+                self.values.append([])
+            cells = self.values[r]
+            end = col + len(row_values)
+            cells.extend([None] * (end - len(cells)))
+            cells[col:end] = row_values
+        self.row_count = max(self.row_count, len(self.values))
+        self.col_count = max([self.col_count] + [len(cells) for cells in self.values])
+
+
+def _transpose(values, fill):
+    n = max((len(row) for row in values), default=0)
+    return [[row[i] if i < len(row) else fill for row in values] for i in range(n)]
+
+
+def _trim(values):
+    values = [list(row) for row in values]
+    for row in values:
+        while row and row[-1] == "":
+            row.pop()
+    while values and not values[-1]:
+        values.pop()
+    return values
+
+
+SHEETS_BACKENDS = {backend.name: backend for backend in (GspreadBackend(), LocalBackend())}
+
+
+def get_sheets_backend(name=None):
+    """:return: The named spreadsheet backend, settings.SHEETS_BACKEND by default"""
+    return SHEETS_BACKENDS[name or settings.SHEETS_BACKEND]
@@ -0,0 +1,48 @@
+"""
+Similarity backends for answer coding, each scores one string against many choices in one call.
+"""
+
+import numpy as np
+from django.conf import settings
+from fuzzywuzzy import fuzz
+from rapidfuzz import fuzz as rapid_fuzz
+from rapidfuzz.process import cdist
+
+
+class FuzzyWuzzyScorer:
+    name = "fuzzywuzzy"
+
+    def ratio(self, query, choices):
+        return np.fromiter((fuzz.ratio(query, c) for c in choices), dtype="int64", count=len(choices))
+
+    def partial_ratio(self, query, choices):
+        return np.fromiter((fuzz.partial_ratio(query, c) for c in choices), dtype="int64", count=len(choices))
+
+
+class RapidFuzzScorer:
+    name = "rapidfuzz"
+
+    def ratio(self, query, choices):
+        return self._cdist(rapid_fuzz.ratio, query, choices)
+
+    def partial_ratio(self, query, choices):
+        return self._cdist(rapid_fuzz.partial_ratio, query, choices)
+
+    @staticmethod
+    def _cdist(scorer, query, choices):
+        if not choices:
+            return np.zeros(0, dtype="int64")
+        # fuzzywuzzy scores identical strings 100 and anything against an empty string 0
+        scores = np.rint(cdist([query], choices, scorer=scorer, dtype=np.float64)[0]).astype("int64")
+        if not query:
+            scores[:] = 0
+        scores[[c == query for c in choices]] = 100
+        return scores
+
+
+SCORERS = {scorer.name: scorer for scorer in (FuzzyWuzzyScorer(), RapidFuzzScorer())}
+
+
+def get_scorer(name=None):
+    """:return: The named scorer, settings.ROLLUP_SCORER by default"""
+    return SCORERS[name or settings.ROLLUP_SCORER]
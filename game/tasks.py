@@ -1,14 +1,15 @@
 from datetime import datetime
 from pytz import timezone
-from collections import deque
-from copy import deepcopy
 
+import numpy as np
 import pandas as pd
 from celery import shared_task
 
 from django.utils.timezone import make_aware
 from django.db import transaction
-from game.models import Question, Answer, AnswerCode
+from game.models import Game, Question, Answer, AnswerCode
+from game.rollups import code_new_answers
+from project.utils import REDIS
 from django.contrib.auth import get_user_model
 
 
@@ -27,6 +28,27 @@ def api_to_db(game, responses, answer_codes, update):
     print("finished logging to db")
 
 
+@shared_task
+def code_new_answers_of_game(gid):
+    """
+    Runs code_new_answers after a submission. One worker codes a game at a time: submissions that
+    arrive meanwhile mark the game so the worker runs again, and codes them all in one pass.
+    """
+    pending_key = f"autocode_pending_{gid}"
+    lock_key = f"autocode_lock_{gid}"
+    REDIS.set(pending_key, "true", timeout=10 * 60)
+    game = Game.objects.get(id=gid)
+    # a submission that marks the game after the last check but before the lock is released finds it
+    # locked, so the mark is checked again once the lock is gone
+    while REDIS.get(pending_key) and REDIS.add(lock_key, "true", timeout=10 * 60):
+        try:
+            while REDIS.get(pending_key):
+                REDIS.delete(pending_key)
+                code_new_answers(game)
+        finally:
+            REDIS.delete(lock_key)
+
+
 @transaction.atomic
 def questions_to_db(game, responses):
     q_text = responses.columns[3:]
@@ -43,11 +65,48 @@ def questions_to_db(game, responses):
 
 @transaction.atomic
 def players_to_db(series, responses):
-    player_list = zip(responses["Name"].tolist(), responses["Email Address"].tolist())
+    """
+    Upserts the responding players and adds them to the series with a handful of queries. New players
+    get what Player.save and the add_names_and_follow signal would give them: a code, first and last
+    names from the display name, and a follow of themselves.
+    """
     User = get_user_model()
-    for dn, e in player_list:
-        p, created = User.objects.update_or_create(email=e, defaults={"display_name": dn[:100]})
-        series.players.add(p)
+    # emails are case insensitive, and the last response of an email wins like it did with update_or_create
+    responders = {
+        e.lower(): (e, dn[:100]) for dn, e in zip(responses["Name"].tolist(), responses["Email Address"].tolist())
+    }
+    players = {p.email.lower(): p for p in User.objects.filter(email__in=[e for e, _ in responders.values()])}
+
+    changed, new_players = [], []
+    for key, (e, dn) in responders.items():
+        p = players.get(key)
+        if p is None:
+            p = User(email=e, display_name=dn)
+            parsed_name = dn.split()
+            if parsed_name:
+                p.first_name = parsed_name.pop(0)[:30]
+                p.last_name = " ".join(parsed_name)[:30]
+            new_players.append(p)
+            players[key] = p
+        elif p.display_name != dn:
+            p.display_name = dn
+            changed.append(p)
+
+    User.objects.bulk_update(changed, ["display_name"], batch_size=1000)
+    for p, code in zip(new_players, User.unique_codes(len(new_players))):
+        p._code = code
+    User.objects.bulk_create(new_players, batch_size=1000)
+
+    Following = User.following.through
+    Following.objects.bulk_create(
+        [Following(from_player_id=p.id, to_player_id=p.id) for p in new_players], batch_size=1000, ignore_conflicts=True
+    )
+    SeriesPlayer = series.players.through
+    SeriesPlayer.objects.bulk_create(
+        [SeriesPlayer(series_id=series.id, player_id=p.id) for p in players.values()],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
 
 
 def answers_to_db(game, responses, update=False):
@@ -59,20 +118,30 @@ def answers_to_db(game, responses, update=False):
 
 @transaction.atomic
 def update_answers_in_db(game, responses):
-    User = get_user_model()
-    prev_players = User.objects.filter(answers__question__game=game).values_list("email", flat=True)
-    prev_answers = Answer.objects.filter(question__game=game, player__email__in=prev_players).values(
-        "id", "question__text", "raw_string", "player__email"
+    prev_answers = Answer.objects.filter(question__game=game).values_list(
+        "id", "player__email", "question__text", "raw_string"
     )
-    new_answers = []
-    for pa in prev_answers:
-        new_answer = responses.at[
-            int(responses[responses["Email Address"] == pa["player__email"]].index[0]), pa["question__text"]
-        ]
-        if new_answer != pa["raw_string"]:
-            pa["raw_string"] = new_answer
-            new_answers.append(Answer(id=pa["id"], raw_string=new_answer))
-    Answer.objects.bulk_update(new_answers, ["raw_string"])
+    changes = changed_answers(prev_answers, responses)
+    Answer.objects.bulk_update(
+        [Answer(id=a_id, raw_string=raw_string) for a_id, raw_string in changes], ["raw_string"], batch_size=1000
+    )
+
+
+def changed_answers(prev_answers, responses):
+    """
+    Diffs answers in the database against the responses, joining on player email and question text.
+    Answers of players or questions missing from the responses are left alone.
+    :param prev_answers: Iterable of (answer id, player email, question text, raw_string)
+    :param responses: Responses dataframe as returned by api_data_to_df
+    :return: List of (answer id, new raw_string) for the answers whose response changed
+    """
+    prev = pd.DataFrame.from_records(list(prev_answers), columns=["id", "Email Address", "question_text", "raw_string"])
+    current = responses.drop_duplicates("Email Address").melt(
+        id_vars="Email Address", value_vars=responses.columns[3:], var_name="question_text", value_name="new_raw"
+    )
+    diff = prev.merge(current, on=["Email Address", "question_text"], how="inner")
+    diff = diff[diff["raw_string"] != diff["new_raw"]]
+    return list(zip(diff["id"].tolist(), diff["new_raw"].tolist()))
 
 
 @transaction.atomic
@@ -115,46 +184,49 @@ def answers_codes_to_db(game, answer_codes):
     AnswerCode.objects.bulk_update_or_create(answers, ["coded_answer"], match_field=("question", "raw_string"))
 
 
-def raw_answers_db_to_df(game):
+def raw_answers_db_to_df(game, answers=None):
     """
-    Accepts many answer objects for players and creates a grid-like list-of-lists
-    where each list is for a given player, and includes timestamp, email, display_name
-    and the raw_string value for each question in the game
+    Loads the raw answers of the game in one query and pivots them to one row per player, with the
+    timestamp of the player's first answer, email, display_name and the raw_string for each question.
+    Questions a player skipped are None, or "" after the player's last answer.
+    :param game: The game object
+    :param answers: Answers to include, game.raw_player_answers by default
     """
-    raw_player_answers = deque(
-        game.raw_player_answers.values_list(
-            "player__email",
-            "player__display_name",
-            "timestamp",
-            "question__text",
-            "raw_string",
-        )
+    if answers is None:
+        answers = game.raw_player_answers
+    questions = list(game.questions.order_by("number").values_list("id", "text"))
+    q_ids = [q_id for q_id, _ in questions]
+    qtext = [q_text for _, q_text in questions]
+    columns = ["Timestamp", "Email Address", "Name"] + qtext
+    answers = pd.DataFrame.from_records(
+        list(
+            answers.values_list(
+                "player_id", "player__email", "player__display_name", "timestamp", "question_id", "raw_string"
+            )
+        ),
+        columns=["player_id", "Email Address", "Name", "Timestamp", "question_id", "raw_string"],
+    )
+    if answers.empty:
+        return pd.DataFrame(columns=columns, data=[]).sort_values("Timestamp")
+
+    players = answers.drop_duplicates("player_id").set_index("player_id")
+    grid = answers.pivot(index="player_id", columns="question_id", values="raw_string")
+    grid = grid.reindex(index=players.index, columns=q_ids).to_numpy(dtype=object)
+    grid[pd.isna(grid)] = None
+    positions = answers["question_id"].map({q_id: i for i, q_id in enumerate(q_ids)})
+    last_answered = positions.groupby(answers["player_id"]).max().reindex(players.index).to_numpy()
+    grid[np.arange(len(q_ids)) > last_answered[:, None]] = ""
+
+    timestamps = pd.to_datetime(players["Timestamp"], utc=True).dt.tz_convert("US/Eastern")
+    raw_answers_df = pd.DataFrame(
+        columns=columns,
+        data=np.column_stack(
+            [
+                timestamps.dt.strftime("%m/%d/%Y %H:%M:%S").to_numpy(dtype=object),
+                players["Email Address"].to_numpy(dtype=object),
+                players["Name"].to_numpy(dtype=object),
+                grid,
+            ]
+        ),
     )
-    qtext = [q_text for q_text in game.questions.values_list("text", flat=True).order_by("number")]
-
-    raw_answer_data = []
-    while raw_player_answers:
-        qt_cp = deepcopy(qtext)
-        (
-            p_id,
-            p_dn,
-            ts,
-            q_text,
-            ans,
-        ) = raw_player_answers[0]
-        ts = ts.astimezone(tz=timezone("US/Eastern"))
-        p_data = [ts.strftime("%m/%d/%Y %H:%M:%S"), p_id, p_dn]
-        this_p_id = p_id
-        while this_p_id == p_id and raw_player_answers:
-            next_q = qt_cp.pop(0)
-            *_, this_q, ans = raw_player_answers.popleft()
-            while this_q != next_q:
-                p_data.append(None)
-                next_q = qt_cp.pop(0)
-            p_data.append(ans)
-            if raw_player_answers:
-                this_p_id, *_ = raw_player_answers[0]
-        raw_answer_data.append(p_data + [""] * (3 + len(qtext) - len(p_data)))
-
-    raw_answers_df = pd.DataFrame(columns=["Timestamp", "Email Address", "Name"] + qtext, data=raw_answer_data)
     return raw_answers_df.sort_values("Timestamp")
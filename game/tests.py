@@ -7,33 +7,68 @@ import dateutil
 import string
 import random
 import json
+import pickle
 import logging
+import tempfile
 from urllib.parse import quote_plus
 from copy import deepcopy
 from csv import reader
 from dateutil.relativedelta import relativedelta
 
+import gspread
 import pandas as pd
 
 from django.utils.timezone import make_aware
-from django.test import TestCase, Client
+from django.test import TestCase, SimpleTestCase, Client, override_settings
 from django.urls import reverse
 from django.core import mail
 from django.db import IntegrityError
 from django.core.files.storage import FileSystemStorage
 
-from game.gsheets_api import api_data_to_df, build_rollups_and_tallies, make_answers_sheet, make_rollups_sheet
+from game.gsheets_api import (
+    api_data_to_df,
+    build_rollups_and_tallies,
+    make_answers_sheet,
+    make_rollups_sheet,
+    get_sheet_doc,
+    sync_responses_sheet,
+    clear_responses_sync,
+)
+from game.sheets import get_sheets_backend
 from project import settings
 from project.utils import our_now, redis_delete_patterns, REDIS
-from leaderboard.leaderboard import build_filtered_leaderboard, build_answer_tally, lb_cache_key, winners_of_game
+from leaderboard.leaderboard import (
+    build_filtered_leaderboard,
+    build_answer_tally,
+    lb_cache_key,
+    winners_of_game,
+    tabulate_results,
+)
 from leaderboard.tasks import save_last_visit_t
+from leaderboard.cache import delete_cached_leaderboard
 from users.tests import get_local_user, get_local_client, ABINORMAL
 from users.models import Player, PendingEmail
 from game.utils import next_wed_noon, next_friday_1159, write_winner_certificate, n_new_comments
 from game.models import Game, Series, Question, Answer
 from game.views import PSIDMixin, find_latest_public_game
 from game.rollups import *
-from game.tasks import questions_to_db, players_to_db, answers_codes_to_db, answers_to_db
+from game.similarity import SCORERS
+from game.benchmarks import (
+    legacy_autorollup,
+    legacy_changed_answers,
+    legacy_process_rollups,
+    legacy_raw_answers_db_to_df,
+    synthetic_raw_counts,
+    synthetic_responses,
+)
+from game.tasks import (
+    questions_to_db,
+    players_to_db,
+    answers_codes_to_db,
+    answers_to_db,
+    changed_answers,
+    raw_answers_db_to_df,
+)
 from game.forms import QuestionAnswerForm
 from users.tests import test_pw
 from chat.models import Comment
@@ -109,7 +144,7 @@ class BaseGameDataTestCase(TestCase):
 
     @classmethod
     def tearDownClass(cls):
-        REDIS.delete(lb_cache_key(cls.game, cls.answer_tally))
+        delete_cached_leaderboard(lb_cache_key(cls.game, cls.answer_tally))
         super().tearDownClass()
 
     def activate_game(self):
@@ -151,12 +186,192 @@ class TestGameTabulation(BaseGameDataTestCase):
         # test a number string
         self.assertTrue(close_enough("4", "four", {}))
 
+        # normalized forms are interchangeable with strings
+        pretzel = NormalizedAnswer(" Pretzel ")
+        self.assertEqual((pretzel.text, pretzel.length, pretzel.is_int), ("pretzel", 7, False))
+        self.assertTrue(close_enough(pretzel, NormalizedAnswer("pretxel"), {}))
+        self.assertTrue(close_enough(NormalizedAnswer("4"), "Four", {}))
+        self.assertFalse(close_enough("four", NormalizedAnswer("4"), {}))
+        self.assertTrue(close_enough("Mapel", NormalizedAnswer("maple"), {"maple": "MAPEL "}))
+
+    def test_rollup_index_matches_exhaustive_scan(self):
+        for col in self.resp_df.iloc[:, 3:]:
+            counts = self.resp_df[col].value_counts()
+            self.assertEqual(
+                legacy_process_rollups(col, counts, self.rollups), process_rollups(col, counts, self.rollups)
+            )
+            self.assertEqual(legacy_process_rollups(col, counts, {}), process_rollups(col, counts, {}))
+
+        raw_counts = synthetic_raw_counts(n_responses=2000)
+        self.assertEqual(legacy_process_rollups("q", raw_counts, {}), process_rollups("q", raw_counts, {}))
+
+        # every rollup close_enough() accepts is shortlisted
+        rollup_names = list(raw_counts.index[:300])
+        rollup_index = RollupIndex({})
+        for rollup_name in rollup_names:
+            rollup_index.add(rollup_name)
+        for answer in raw_counts.index[300:600]:
+            candidates = rollup_index.candidates(answer)
+            expected = [r for r in rollup_names if close_enough(answer, r, {})]
+            self.assertListEqual(expected, [r.raw for r in candidates if close_enough(answer, r, {})])
+
+    def test_similarity_backends_make_the_same_merges(self):
+        for col in self.resp_df.iloc[:, 3:]:
+            counts = self.resp_df[col].value_counts()
+            expected = legacy_process_rollups(col, counts, self.rollups)
+            for scorer in SCORERS:
+                self.assertEqual(expected, process_rollups(col, counts, self.rollups, scorer=scorer))
+
+            # the batched close_enough agrees with the pairwise reference
+            answers = [NormalizedAnswer(a) for a in counts.index]
+            for answer in answers[:20]:
+                expected = [close_enough(answer, a, self.rollups.get(col, {})) for a in answers]
+                for scorer in SCORERS:
+                    matches = close_enough_many(answer, answers, self.rollups.get(col, {}), scorer)
+                    self.assertListEqual(expected, matches.tolist())
+
+    def test_autocode_matcher_matches_exhaustive_scan(self):
+        raw_counts = synthetic_raw_counts(n_responses=2000)
+        _, processed = process_rollups("q", raw_counts.iloc[200:], {})
+        coded_answers = {raw: code for code, raws in processed.items() for raw in raws}
+        matcher = AutocodeMatcher(coded_answers)
+        for answer in list(raw_counts.index[:200]) + ["", "12", "twelve", "zzzz"]:
+            self.assertEqual(legacy_autorollup(coded_answers, answer), matcher.autocode(answer))
+        self.assertEqual(AutocodeMatcher({}).autocode("Ontario"), "Ontario")
+
+        # the RollupIndex isn't pickled, it's rebuilt when the matcher is loaded
+        self.assertNotIn(b"RollupIndex", pickle.dumps(matcher))
+        loaded = pickle.loads(pickle.dumps(matcher))
+        for answer in raw_counts.index[:50]:
+            self.assertEqual(matcher.autocode(answer), loaded.autocode(answer))
+
+    def test_question_autocode_matcher_cache(self):
+        question = Question.objects.get(text="Excluding Forest Gump, name a Tom Hanks movie.")
+        clear_autocode_matchers([question])
+        matcher = question_autocode_matcher(question)
+        self.assertIs(matcher, question_autocode_matcher(question))
+        raw_string, coded_answer = next(iter(matcher.coded_answers.items()))
+        self.assertEqual(autorollup_question_answer(question, raw_string), coded_answer)
+
+        # rebuilding it drops the copy held by this process
+        AnswerCode.objects.filter(question=question, raw_string=raw_string).update(coded_answer="Recoded")
+        cache_autocode_matcher(question)
+        self.assertEqual(autorollup_question_answer(question, raw_string), "Recoded")
+        AnswerCode.objects.filter(question=question, raw_string=raw_string).update(coded_answer=coded_answer)
+        clear_autocode_matchers([question])
+
+    def test_autocode_answers_are_remembered(self):
+        question = Question.objects.get(text="Excluding Forest Gump, name a Tom Hanks movie.")
+        cache_autocode_matcher(question)
+        autocode_cache_counts.clear()
+        coded_answer = autorollup_question_answer(question, "Castawey!")
+        self.assertEqual(autorollup_question_answer(question, "Castawey!"), coded_answer)
+        self.assertEqual(dict(autocode_cache_counts), {"misses": 1, "local_hits": 1})
+
+        # another worker finds it in redis
+        clear_local_autocodes()
+        autorollup_question_answer(question, "Castawey!")
+        self.assertEqual(autocode_cache_counts["redis_hits"], 1)
+
+        # and it's recoded once the question's matcher is rebuilt
+        cache_autocode_matcher(question)
+        autorollup_question_answer(question, "Castawey!")
+        self.assertEqual(autocode_cache_counts["misses"], 2)
+        clear_autocode_matchers([question])
+
     def test_build_rollups_dict(self):
         # make sure it's still a list of dicts for all questions
         expected_qs = list(self.resp_df.iloc[:, 3:-2].columns)
         rollup_qs = list(self.rollups.keys())
         self.assertEqual(expected_qs, rollup_qs)
 
+    def test_build_answer_codes_in_parallel(self):
+        answer_codes = build_answer_codes(self.resp_df, self.rollups, workers=4)
+        self.assertEqual(list(self.answer_codes), list(answer_codes))
+        self.assertEqual(self.answer_codes, answer_codes)
+
+    def test_answer_merges(self):
+        merges = answer_merges(self.game)
+        self.assertEqual(list(merges), list(self.game.questions.order_by("number").values_list("text", flat=True)))
+        for q_text, q_merges in merges.items():
+            self.assertEqual(q_merges, question_merges(self.game, q_text))
+
+    def test_rollup_profile(self):
+        profile = []
+        answer_codes = build_answer_codes(self.resp_df, self.rollups, profile=profile)
+        self.assertEqual(answer_codes, self.answer_codes)
+        self.assertEqual([p["question"] for p in profile], list(self.resp_df.columns[3:]))
+        for question_profile in profile:
+            col = question_profile["question"]
+            self.assertEqual(question_profile["unique_responses"], self.resp_df[col].nunique())
+            self.assertLessEqual(question_profile["fuzzy_comparisons"], question_profile["close_enough_calls"])
+
+        # every response is in the rollups sheet or a rollup of its own when the sheet is complete
+        answer_codes_as_rollups = {
+            q: {raw: code for code, raws in codes.items() for raw in raws} for q, codes in answer_codes.items()
+        }
+        profile = []
+        build_answer_codes(self.resp_df, answer_codes_as_rollups, profile=profile)
+        self.assertTrue(all(p["rollup_hits"] == p["unique_responses"] for p in profile))
+        self.assertIn(profile[0]["question"][:50], rollup_profile_summary(profile))
+
+    def test_historical_rollups(self):
+        col = self.resp_df.columns[4]
+        raw_string = self.resp_df[col].iloc[0]
+        learn_rollups(self.game, {f" {col.upper()} ": {f" {raw_string.upper()}": "An Earlier Code", "x": ""}})
+        self.assertEqual(HistoricalAnswerCode.objects.count(), 1)
+        self.assertEqual(historical_rollups([col])[col], {" ".join(raw_string.lower().split()): "An Earlier Code"})
+
+        # approved codes are looked up before fuzzy matching, the rollups sheet still wins
+        answer_codes = build_answer_codes(self.resp_df, {}, history=True)
+        self.assertIn(raw_string, answer_codes[col]["An Earlier Code"])
+        answer_codes = build_answer_codes(self.resp_df, {col: {raw_string: "Sheet Code"}}, history=True)
+        self.assertIn(raw_string, answer_codes[col]["Sheet Code"])
+
+    def test_edited_rollups(self):
+        # the codes the sheet was written with aren't edits
+        rollups = {
+            q: {raw: code for code, raws in codes.items() for raw in raws} for q, codes in self.answer_codes.items()
+        }
+        self.assertEqual(edited_rollups(self.game, rollups), {})
+
+        col = self.resp_df.columns[4]
+        raw_string = self.resp_df[col].iloc[0]
+        rollups[col][raw_string] = "A Human Code"
+        self.assertEqual(edited_rollups(self.game, rollups), {col: {raw_string: "A Human Code"}})
+
+    def test_code_new_answers(self):
+        code_new_answers(self.game)
+        self.assertEqual(code_new_answers(self.game), 0)
+
+        question = Question.objects.get(text="Excluding Forest Gump, name a Tom Hanks movie.")
+        coded_answer = question.coded_answers.first().coded_answer
+        player = get_local_user(e="streamer@fakeemail.com")
+        Answer.objects.create(player=player, question=question, raw_string=f" {coded_answer.upper()} ")
+        new_player = get_local_user(e="streamer2@fakeemail.com")
+        Answer.objects.create(player=new_player, question=question, raw_string="Zzyzxq Qwvjk")
+        self.assertEqual(code_new_answers(self.game), 2)
+        self.assertEqual(question.coded_answers.get(raw_string=f" {coded_answer.upper()} ").coded_answer, coded_answer)
+        new_code = question.coded_answers.get(raw_string="Zzyzxq Qwvjk").coded_answer
+        self.assertEqual(new_code, "Zzyzxq Qwvjk")
+
+        # tabulation keeps the streamed group, named by its most common spelling
+        for i in range(2):
+            player = get_local_user(e=f"streamer{i + 3}@fakeemail.com")
+            Answer.objects.create(player=player, question=question, raw_string="zzyzxq qwvjk")
+        code_new_answers(self.game)
+        self.assertEqual(question.coded_answers.get(raw_string="zzyzxq qwvjk").coded_answer, "Zzyzxq Qwvjk")
+        rollups = with_streamed_rollups(self.game, raw_answers_db_to_df(self.game), {})
+        self.assertEqual(rollups[question.text]["Zzyzxq Qwvjk"], "zzyzxq qwvjk")
+        self.assertEqual(rollups[question.text]["zzyzxq qwvjk"], "zzyzxq qwvjk")
+        self.assertEqual(rollups[question.text][f" {coded_answer.upper()} "], coded_answer)
+
+        # the rollups sheet still wins
+        rollups = with_streamed_rollups(
+            self.game, raw_answers_db_to_df(self.game), {question.text: {"Zzyzxq Qwvjk": "Joe"}}
+        )
+        self.assertEqual(rollups[question.text]["Zzyzxq Qwvjk"], "Joe")
+
     def test_default_rollups(self):
         # make sure we've assigned some value to non-reviewed rollups
         missing_rollups = deepcopy(self.rollups)
@@ -208,6 +423,31 @@ class TestGameTabulation(BaseGameDataTestCase):
         new_display_name = User.objects.get(email="long_name@fakeemail.com").display_name
         self.assertEqual(new_display_name, long_name[:100])
 
+    def test_players_to_db_creates_players(self):
+        new_players_df = pd.DataFrame(
+            columns=["Email Address", "Name"],
+            data=[
+                ["new1@fakeemail.com", "First Middle Last"],
+                ["new2@fakeemail.com", "Mononym"],
+                ["user2@fakeemail.com", "Renamed"],
+            ],
+        )
+        players_to_db(self.series, new_players_df)
+        User = get_user_model()
+        p1 = User.objects.get(email="new1@fakeemail.com")
+        p2 = User.objects.get(email="new2@fakeemail.com")
+        self.assertEqual((p1.first_name, p1.last_name), ("First", "Middle Last"))
+        self.assertEqual((p2.first_name, p2.last_name), ("Mononym", ""))
+        self.assertNotEqual(p1.code, p2.code)
+        self.assertEqual(len(p1.code), 5)
+        self.assertEqual(p1.following_ids, {p1.id})
+        self.assertEqual(User.objects.get(email="user2@fakeemail.com").display_name, "Renamed")
+        self.assertEqual(self.series.players.filter(email__in=new_players_df["Email Address"]).count(), 3)
+
+        # running again changes nothing
+        players_to_db(self.series, new_players_df)
+        self.assertEqual(User.objects.filter(email="new1@fakeemail.com").count(), 1)
+
     def test_answers_to_db(self):
         # test answers to game questions
         answers = Answer.objects.exclude(question__type=Question.op)
@@ -217,6 +457,34 @@ class TestGameTabulation(BaseGameDataTestCase):
         answers_to_db(self.game, self.resp_df)
         self.assertEqual(answers.count(), 290)
 
+    def test_update_answers_in_db(self):
+        resp_df = self.resp_df.copy()
+        q_text = resp_df.columns[4]
+        email = resp_df["Email Address"].iloc[0]
+        resp_df.loc[resp_df.index[0], q_text] = "A changed answer"
+        answers_to_db(self.game, resp_df, update=True)
+        self.assertEqual(Answer.objects.get(question__text=q_text, player__email=email).raw_string, "A changed answer")
+        self.assertEqual(Answer.objects.filter(raw_string="A changed answer").count(), 1)
+
+        # the joined diff finds the same changes as scanning the responses per answer
+        responses, prev_answers = synthetic_responses(n_players=200, n_questions=5, changed=0.1)
+        expected = legacy_changed_answers(prev_answers, responses)
+        self.assertGreater(len(expected), 0)
+        self.assertListEqual(sorted(expected), sorted(changed_answers(prev_answers, responses)))
+
+    def test_raw_answers_db_to_df(self):
+        pd.testing.assert_frame_equal(legacy_raw_answers_db_to_df(self.game), raw_answers_db_to_df(self.game))
+
+        # skipped questions are None before a player's last answer and blank after it
+        email = self.resp_df["Email Address"].iloc[0]
+        player_answers = Answer.objects.filter(player__email=email, question__game=self.game)
+        player_answers.filter(question__number__in=[1, 11]).update(removed=True)
+        raw_answers_df = raw_answers_db_to_df(self.game)
+        pd.testing.assert_frame_equal(legacy_raw_answers_db_to_df(self.game), raw_answers_df)
+        player_row = raw_answers_df[raw_answers_df["Email Address"] == email].iloc[0]
+        self.assertIsNone(player_row[self.questions[1].text])
+        self.assertEqual(player_row[self.questions[11].text], "")
+
     def test_blank_answers(self):
         new_user_email = "userx@fakeemail.com"
         User = get_user_model()
@@ -295,6 +563,101 @@ class TestGSheetsAPI(BaseGameDataTestCase):
         rollups_sheet = make_rollups_sheet(self.rollups_and_tallies)
         self.assertEqual(rollups_sheet, expected_rollups_sheet)
 
+    @override_settings(SHEETS_BACKEND="local")
+    def test_sync_responses_sheet(self):
+        get_sheets_backend("local").clear()
+        clear_responses_sync([self.game])
+        sheet_doc = get_sheet_doc(self.game)
+
+        # the first sync writes the whole sheet
+        self.assertTrue(sync_responses_sheet(self.game, sheet_doc))
+        rows = sheet_doc.values_get("[auto] raw responses")["values"]
+        self.assertEqual(len(rows), len(raw_answers_db_to_df(self.game)) + 1)
+        self.assertFalse(sync_responses_sheet(self.game, sheet_doc))
+
+        # a new player is appended
+        p = get_user_model().objects.create(email="synced@fakeemail.com", display_name="Synced Player")
+        Answer.objects.bulk_create([Answer(player=p, question=q, raw_string="Synced") for q in self.questions])
+        self.assertFalse(sync_responses_sheet(self.game, sheet_doc))
+        appended = sheet_doc.values_get("[auto] raw responses")["values"]
+        self.assertEqual(appended[:-1], rows)
+        self.assertEqual(appended[-1][1:4], ["synced@fakeemail.com", "Synced Player", "Synced"])
+
+        # so does editing a synced answer or player
+        Answer.objects.filter(player=p, question=self.questions[1]).update(raw_string="Edited")
+        self.assertTrue(sync_responses_sheet(self.game, sheet_doc))
+        edited_row = sheet_doc.values_get("[auto] raw responses")["values"][-1]
+        self.assertEqual(edited_row[1:5], ["synced@fakeemail.com", "Synced Player", "Synced", "Edited"])
+        get_user_model().objects.filter(id=p.id).update(display_name="Renamed Player")
+        self.assertTrue(sync_responses_sheet(self.game, sheet_doc))
+        self.assertFalse(sync_responses_sheet(self.game, sheet_doc))
+
+        # removing a synced answer rewrites the sheet
+        Answer.objects.filter(player=p, question=self.questions[0]).update(removed=True)
+        self.assertTrue(sync_responses_sheet(self.game, sheet_doc))
+        rewritten = sheet_doc.values_get("[auto] raw responses")["values"]
+        self.assertEqual(len(rewritten), len(appended))
+        synced_row = next(row for row in rewritten if row[1] == "synced@fakeemail.com")
+        self.assertEqual(synced_row[3:5], ["", "Edited"])
+
+    @override_settings(SHEETS_BACKEND="local", ROLLUP_WORKERS=1)
+    def test_tabulate_results_offline(self):
+        get_sheets_backend("local").clear()
+        sheet_doc = get_sheet_doc(self.game)
+        with open(self.resp_fp, "r") as f:
+            sheet_doc.add_worksheet("Form Responses 1", 100, 20).update(list(reader(f)))
+        with open(self.rollup_fp, "r") as f:
+            sheet_doc.add_worksheet("[auto] rollups", 500, 100).update(list(reader(f)), major_dimension="COLUMNS")
+
+        with tempfile.TemporaryDirectory() as root, override_settings(ROLLUP_PROFILE_ROOT=root):
+            tabulate_results(self.game)
+            self.assertEqual(len(os.listdir(root)), 1)
+        raw_responses = sheet_doc.values_get("[auto] raw responses")["values"]
+        self.assertEqual(len(raw_responses), len(self.resp_df) + 1)
+        leaderboard = build_filtered_leaderboard(self.game, build_answer_tally(self.game))
+        self.assertEqual(len(sheet_doc.values_get("[auto] leaderboard")["values"]), len(leaderboard) + 1)
+        answers_sheet = sheet_doc.values_get("[auto] answers", params={"major_dimension": "COLUMNS"})["values"]
+        self.assertEqual(answers_sheet[0][0], self.resp_df.columns[3])
+
+
+class TestLocalSheets(SimpleTestCase):
+
+    def setUp(self):
+        self.sheet_doc = get_sheets_backend("local").open("Test Local Sheets")
+
+    def tearDown(self):
+        get_sheets_backend("local").clear()
+
+    def test_worksheets(self):
+        with self.assertRaises(gspread.exceptions.WorksheetNotFound):
+            self.sheet_doc.worksheet("Sheet")
+        sheet = self.sheet_doc.add_worksheet("Sheet", 2, 2)
+        with self.assertRaises(gspread.exceptions.APIError):
+            self.sheet_doc.add_worksheet("Sheet", 2, 2)
+        self.assertIs(self.sheet_doc.worksheet("Sheet"), sheet)
+        self.assertNotIn("values", self.sheet_doc.values_get("Sheet"))
+
+    def test_values(self):
+        sheet = self.sheet_doc.add_worksheet("Sheet", 2, 2)
+        sheet.update([["a", "b", None], [1, 2, ""]])
+        sheet.append_rows([["c", 3]])
+        self.assertEqual(self.sheet_doc.values_get("Sheet")["values"], [["a", "b"], ["1", "2"], ["c", "3"]])
+        columns = self.sheet_doc.values_get("Sheet", params={"major_dimension": "COLUMNS"})["values"]
+        self.assertEqual(columns, [["a", "1", "c"], ["b", "2", "3"]])
+
+        sheet.clear()
+        sheet.update(columns, major_dimension="COLUMNS")
+        self.assertEqual(self.sheet_doc.values_get("Sheet")["values"], [["a", "b"], ["1", "2"], ["c", "3"]])
+        sheet.update("B4", [["d"]])
+        self.assertEqual(self.sheet_doc.values_get("Sheet")["values"][-1], ["", "d"])
+
+    def test_files(self):
+        with tempfile.TemporaryDirectory() as root, override_settings(LOCAL_SHEETS_ROOT=root):
+            get_sheets_backend("local").open("Test File Sheets").add_worksheet("Sheet", 1, 1).update([[1, "x"]])
+            get_sheets_backend("local").clear()
+            sheet_doc = get_sheets_backend("local").open("Test File Sheets")
+            self.assertEqual(sheet_doc.values_get("Sheet")["values"], [["1", "x"]])
+
 
 class TestUtils(TestCase):
 
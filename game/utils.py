@@ -4,13 +4,13 @@ from os import environ as env
 import subprocess
 import datetime
 
-from django.db.models import Min, F, Count
+from django.db.models import Count, F, Min
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.admin.models import LogEntry, CHANGE
 from project.settings import WINNER_ROOT, WINNER_TEMPLATE_PDF
 from project.utils import our_now, quick_cache, to_ascii
 from game.models import Game, Answer
-from leaderboard.models import PlayerRankScore
+from leaderboard.models import LeaderboardSummary, PlayerRankScore
 from chat.models import Comment
 
 
@@ -181,10 +181,15 @@ def n_new_comments(game, player, t):
 
 @quick_cache()
 def number_of_players_in_all_games(slug):
-    players_with_filter_count = (
-        PlayerRankScore.objects.filter(leaderboard__game__series__slug=slug, leaderboard__publish_date__lte=our_now())
+    published = {"leaderboard__game__series__slug": slug, "leaderboard__publish_date__lte": our_now()}
+    player_counts = dict(
+        LeaderboardSummary.objects.filter(**published).values_list("leaderboard__game__game_id", "player_count")
+    )
+    # leaderboards whose summary isn't saved yet are counted from their player rank scores
+    unsummarized = (
+        PlayerRankScore.objects.filter(leaderboard__summary__isnull=True, **published)
         .values(game_id=F("leaderboard__game__game_id"))
-        .annotate(num_players=Count("game_id"))
-        .order_by("game_id")
+        .annotate(num_players=Count("id"))
     )
-    return OrderedDict((game["game_id"], game["num_players"]) for game in players_with_filter_count)
+    player_counts.update((game["game_id"], game["num_players"]) for game in unsummarized)
+    return OrderedDict(sorted(player_counts.items()))
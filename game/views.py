@@ -36,7 +36,8 @@ from game.forms import (
 )
 from game.models import Game, Series, Question, Answer
 from game.gsheets_api import write_new_responses_to_gdrive
-from game.rollups import autorollup_question_answer
+from game.tasks import code_new_answers_of_game
+from game.rollups import autorollup_question_answer, flush_autocode_cache_counts
 from game.utils import find_latest_public_game, find_latest_published_game, write_winner_certificate
 from leaderboard.leaderboard import tabulate_results, winners_of_game
 from users.models import PendingEmail, Player
@@ -191,6 +192,7 @@ class GameFormView(FormMixin, PSIDMixin, BaseGameView):
         self._save_forms(game_forms)
         self.email_player_success(request, game, player)
         write_new_responses_to_gdrive.delay(game.id)
+        code_new_answers_of_game.delay(game.id)
 
         check_for_reward(player)
 
@@ -374,12 +376,13 @@ class InstantGameView(GameFormView):
 
     def _autocode_responses_and_save_to_session(self, request, game_forms):
         request.session[f"game_{self.game.game_id}_answers"] = {}
-        for question in self.questions.prefetch_related("coded_answers"):
+        for question in self.questions:
             game_form = game_forms[question.id]
             raw_player_answer = game_form.data.get("raw_string")
             # this is the magic line that does the auto-rollups of inputs
             coded_player_answer = autorollup_question_answer(question, raw_player_answer)
             request.session[f"game_{self.game.game_id}_answers"][question.id] = coded_player_answer
+        flush_autocode_cache_counts()
 
     def get_game_rules(self):
         try:
@@ -10,6 +10,7 @@ from sortedm2m_filter_horizontal_widget.forms import SortedFilteredSelectMultipl
 from components.models import Component
 from leaderboard.models import Leaderboard, LeaderboardMessage
 from leaderboard.leaderboard import tabulate_results, clear_leaderboard_cache
+from game.rollups import rollup_profile_summary
 
 
 @admin.register(Leaderboard)
@@ -61,8 +62,9 @@ class LeaderboardAdmin(DjangoObjectActions, admin.ModelAdmin):
 
     def _score_game(self, request, game, update=False):
         try:
-            tabulate_results(game, update)
+            rollup_profile = tabulate_results(game, update)
             self.message_user(request, f"{game.name} has successfully been scored!")
+            self.message_user(request, rollup_profile_summary(rollup_profile))
         except Exception as e:
             self.message_user(request, "An unexpected error occurred. Ping Ted.", level=messages.ERROR)
             logging.error("Exception occurred", exc_info=True)
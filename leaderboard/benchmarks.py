@@ -0,0 +1,269 @@
+"""
+Synthetic data, legacy reference implementations and timing helpers for the leaderboard engine.
+"""
+
+import subprocess
+import time
+from collections import deque, OrderedDict
+
+import numpy as np
+import pandas as pd
+from django.db.models import Sum, Subquery, OuterRef
+from django.urls import reverse
+
+from project.utils import our_now
+from users.models import Player
+from game.models import Series, Game, Question, Answer, AnswerCode
+from leaderboard.engine import build_leaderboard_frame, score_and_rank
+from leaderboard.leaderboard import (
+    build_answer_tally,
+    build_leaderboard_fromdb,
+    build_filtered_leaderboard,
+    clear_leaderboard_cache,
+    rank_score_lists,
+    save_leaderboard_rank_scores,
+    tabulate_results,
+)
+
+
+def synthetic_coded_answers(n_players=50000, n_questions=10, n_answers=200, zipf_a=1.3, seed=0):
+    """
+    Builds coded player answers, an answer tally and question columns that look like a real game,
+    with answers drawn from a Zipf distribution so a few popular answers carry most players
+    :return: coded_player_answers (as returned by Game.coded_player_answers), answer_tally, lb_cols
+    """
+    rng = np.random.default_rng(seed)
+    lb_cols = [f"Synthetic question {q}?" for q in range(n_questions)]
+    answer_idx = np.minimum(rng.zipf(zipf_a, size=(n_players, n_questions)), n_answers) - 1
+
+    answer_tally = {}
+    for q, q_text in enumerate(lb_cols):
+        counts = np.bincount(answer_idx[:, q], minlength=n_answers)
+        tally = {f"answer {a}": int(c) for a, c in enumerate(counts) if c}
+        answer_tally[q_text] = OrderedDict(sorted(tally.items(), key=lambda x: -x[1]))
+
+    coded_player_answers = [
+        (p_id + 1, f"Player {p_id + 1}", q_text, f"answer {answer_idx[p_id, q]}", p_id == 0)
+        for p_id in range(n_players)
+        for q, q_text in enumerate(lb_cols)
+    ]
+    return coded_player_answers, answer_tally, lb_cols
+
+
+def legacy_leaderboard_frame(coded_player_answers, answer_tally, lb_cols):
+    """The original per-player deque loop from build_leaderboard_fromdb"""
+    cpas = deque(coded_player_answers)
+    lb_data = []
+
+    while cpas:
+        p_id, p_dn, q_text, ans, is_adm = cpas[0]
+        p_data = [p_id, is_adm, p_dn]
+        this_p_id = p_id
+        while this_p_id == p_id and cpas:
+            _, _, q_text, ans, _ = cpas.popleft()
+            try:
+                p_data.append(answer_tally[q_text][ans])
+            except KeyError:
+                p_data.append(0)
+            if cpas:
+                this_p_id, *_ = cpas[0]
+        lb_data.append(p_data)
+
+    leaderboard = pd.DataFrame(columns=["id", "is_host", "Name"] + lb_cols, data=lb_data)
+    leaderboard = score_and_rank(leaderboard, leaderboard[lb_cols].sum(axis=1))
+    return leaderboard[["id", "is_host", "Rank", "Name", "Score"] + lb_cols]
+
+
+def legacy_answer_tally(game):
+    """The original build_answer_tally, a correlated Sum(Subquery) per answer code"""
+    raw_string_counts = game.valid_raw_string_counts
+    answer_subquery = raw_string_counts.filter(raw_string=OuterRef("raw_string")).filter(question=OuterRef("question"))
+    answer_counts = (
+        AnswerCode.objects.filter(question__game=game)
+        .order_by("question__number", "question_id")
+        .values("question__text", "coded_answer")
+        .annotate(score=Sum(Subquery(answer_subquery.values("count"))))
+    )
+    answer_tally = {}
+    for a in answer_counts:
+        score = a["score"] or 0
+        if score == 0:
+            continue
+        if a["question__text"] not in answer_tally:
+            answer_tally[a["question__text"]] = {a["coded_answer"]: score}
+        else:
+            answer_tally[a["question__text"]][a["coded_answer"]] = score
+
+    for q, tally in answer_tally.items():
+        answer_tally[q] = OrderedDict(sorted(tally.items(), key=lambda x: -x[1]))
+    return answer_tally
+
+
+def time_call(func, *args, repeat=3, **kwargs):
+    """Best wall time in seconds of `repeat` calls"""
+    return min(time_runs(func, *args, repeat=repeat, **kwargs))
+
+
+def time_runs(func, *args, repeat=3, **kwargs):
+    """Wall time in seconds of each of `repeat` calls"""
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        runs.append(time.perf_counter() - start)
+    return runs
+
+
+def benchmark_leaderboard_engine(n_players=50000, n_questions=10, repeat=3):
+    cpas, answer_tally, lb_cols = synthetic_coded_answers(n_players, n_questions)
+    legacy = time_call(legacy_leaderboard_frame, cpas, answer_tally, lb_cols, repeat=repeat)
+    engine = time_call(build_leaderboard_frame, cpas, answer_tally, lb_cols, repeat=repeat)
+    return {
+        "players": n_players,
+        "questions": n_questions,
+        "legacy_seconds": legacy,
+        "engine_seconds": engine,
+        "speedup": legacy / engine,
+    }
+
+
+def benchmark_answer_tally(game, repeat=3):
+    legacy = time_call(legacy_answer_tally, game, repeat=repeat)
+    grouped = time_call(build_answer_tally.__wrapped__, game, repeat=repeat)
+    return {"legacy_seconds": legacy, "grouped_seconds": grouped, "speedup": legacy / grouped}
+
+
+SYNTHETIC_SLUG_PREFIX = "benchmark"
+
+
+def check_synthetic_slug(slug):
+    """Synthetic series are deleted by slug, so only slugs that can't be a real series are allowed"""
+    if not slug.startswith(SYNTHETIC_SLUG_PREFIX):
+        raise ValueError(f"Synthetic series slugs must start with {SYNTHETIC_SLUG_PREFIX!r}, got {slug!r}")
+
+
+def create_synthetic_game(slug="benchmark", n_players=1000, n_questions=10, n_answers=200, zipf_a=1.3, seed=0):
+    """
+    Writes a series with one published game to the database: players, game questions, Zipf distributed
+    answers and answer codes. Every coded answer has two raw spellings, so answer codes do real rollups.
+    Players are bulk created and skip the Player post_save hooks.
+    :return: The game object
+    """
+    check_synthetic_slug(slug)
+    rng = np.random.default_rng(seed)
+    email_domain = f"{slug}.benchmark"
+    owner = Player.objects.create_user(email=f"owner@{email_domain}", display_name=f"{slug} owner", is_staff=True)
+    series = Series.objects.create(name=slug, slug=slug, owner=owner, public=True)
+    t = our_now()
+    game = Game.objects.create(series=series, name=f"{slug} game", start=t, end=t)
+    game.leaderboard.publish_date = t
+    game.leaderboard.save()
+
+    questions = [
+        Question.objects.create(game=game, number=q + 1, text=f"Synthetic question {q}?", type=Question.ga)
+        for q in range(n_questions)
+    ]
+    players = Player.objects.bulk_create(
+        [Player(email=f"player{p}@{email_domain}", display_name=f"Player {p}") for p in range(n_players)],
+        batch_size=5000,
+    )
+    series.players.add(*players)
+
+    spellings = ("answer {}", "Answer {}.")
+    answer_idx = np.minimum(rng.zipf(zipf_a, size=(n_players, n_questions)), n_answers) - 1
+    spelling_idx = rng.integers(0, len(spellings), size=(n_players, n_questions))
+    Answer.objects.bulk_create(
+        (
+            Answer(player=player, question=question, raw_string=spellings[spelling_idx[p, q]].format(answer_idx[p, q]))
+            for p, player in enumerate(players)
+            for q, question in enumerate(questions)
+        ),
+        batch_size=10000,
+    )
+    AnswerCode.objects.bulk_create(
+        (
+            AnswerCode(question=question, raw_string=spelling.format(a), coded_answer=f"answer {a}")
+            for question in questions
+            for a in range(n_answers)
+            for spelling in spellings
+        ),
+        batch_size=10000,
+    )
+    return game
+
+
+def delete_synthetic_series(slug="benchmark"):
+    check_synthetic_slug(slug)
+    games = list(Game.objects.filter(series__slug=slug))
+    clear_leaderboard_cache(games)
+    # questions outlive their game (SET_NULL), answers and answer codes go with the questions
+    Question.objects.filter(game__in=games).delete()
+    Series.objects.filter(slug=slug).delete()
+    Player.objects.filter(email__endswith=f"@{slug}.benchmark").delete()
+
+
+def benchmark_leaderboard_build(game, repeat=3):
+    """
+    Times each stage of building and serving a leaderboard for a game in the database
+    :return: {stage: {"best": seconds, "mean": seconds, "runs": [seconds, ...]}}
+    """
+    from django.test import Client
+
+    answer_tally = build_answer_tally(game, force_refresh=True)
+    leaderboard = build_leaderboard_fromdb(game, answer_tally)
+    search_term = leaderboard["Name"].iloc[len(leaderboard) // 2]
+
+    # outside the test runner the default testserver host isn't in ALLOWED_HOSTS
+    client = Client(HTTP_HOST="127.0.0.1")
+    client.force_login(game.series.owner)
+    htmx_url = reverse("leaderboard:htmx")
+    htmx_params = {"game_id": game.game_id, "series": game.series.slug, "page": 2}
+
+    def htmx_leaderboard():
+        response = client.get(htmx_url, htmx_params)
+        assert response.status_code == 200, f"{htmx_url} returned {response.status_code}"
+        return response
+
+    stages = OrderedDict(
+        [
+            ("build_answer_tally", (build_answer_tally, (game,), {"force_refresh": True})),
+            ("build_leaderboard_fromdb", (build_leaderboard_fromdb, (game, answer_tally), {})),
+            ("build_filtered_leaderboard", (build_filtered_leaderboard, (game, answer_tally), {})),
+            (
+                "build_filtered_leaderboard_search",
+                (build_filtered_leaderboard, (game, answer_tally), {"search_term": search_term}),
+            ),
+            (
+                "save_leaderboard_rank_scores",
+                (save_leaderboard_rank_scores, (game.leaderboard.id, *rank_score_lists(leaderboard)), {}),
+            ),
+            ("htmx_leaderboard", (htmx_leaderboard, (), {})),
+        ]
+    )
+    timings = OrderedDict()
+    for stage, (func, args, kwargs) in stages.items():
+        runs = time_runs(func, *args, repeat=repeat, **kwargs)
+        timings[stage] = {"best": min(runs), "mean": sum(runs) / len(runs), "runs": runs}
+    return timings
+
+
+def benchmark_report(timings, **scale):
+    """A JSON serializable report of benchmark timings, tagged with the commit so runs can be compared"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"commit": commit or None, "created": our_now().isoformat(), "scale": scale, "timings": timings}
+
+
+def benchmark_tabulate_results(game, latency=0.0, repeat=1):
+    """
+    Times tabulate_results end to end on the local sheets backend, so no Google account or network is needed
+    :param latency: Seconds each sheets call sleeps, to stand in for the Google Sheets API
+    :return: {"best": seconds, "mean": seconds, "runs": [seconds, ...]}
+    """
+    from django.test import override_settings
+
+    with override_settings(SHEETS_BACKEND="local", LOCAL_SHEETS_LATENCY=latency):
+        runs = time_runs(tabulate_results, game, repeat=repeat)
+    return {"best": min(runs), "mean": sum(runs) / len(runs), "runs": runs}
@@ -0,0 +1,175 @@
+"""
+Leaderboards cached in Redis in a binary format, and in each process while their stamp in Redis is unchanged.
+"""
+
+import json
+import struct
+import threading
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from project.utils import REDIS
+from leaderboard.index import LeaderboardIndex
+
+LOCAL_CACHE_SIZE = 16
+_STAMP_PREFIX = "lbstamp:"
+_local_leaderboards = OrderedDict()
+_local_lock = threading.Lock()
+
+LB_MAGIC = b"CLB"
+LB_FORMAT_VERSION = 1
+_HEADER = struct.Struct("<3sBI")
+_ALIGN = 8
+
+
+def encode_leaderboard(leaderboard):
+    """
+    The format is a header (magic, version, metadata length), JSON metadata describing the columns, then
+    one fixed-width buffer per column. Text columns are int32 codes into a string table.
+    :param leaderboard: A leaderboard DataFrame (see build_leaderboard_frame)
+    :return: bytes in the versioned binary leaderboard format
+    """
+    columns = []
+    buffers = []
+    offset = 0
+
+    def add_buffer(data):
+        nonlocal offset
+        start = offset
+        buffers.append(data)
+        padding = -len(data) % _ALIGN
+        buffers.append(b"\0" * padding)
+        offset += len(data) + padding
+        return start
+
+    for name in leaderboard.columns:
+        values = leaderboard[name]
+        if values.dtype == object:
+            codes, table = pd.factorize(values)
+            table = json.dumps(list(table)).encode()
+            codes = np.ascontiguousarray(codes, dtype="<i4")
+            columns.append(
+                {
+                    "name": name,
+                    "kind": "text",
+                    "table": [add_buffer(table), len(table)],
+                    "offset": add_buffer(codes.tobytes()),
+                }
+            )
+        else:
+            array = np.ascontiguousarray(values.to_numpy())
+            columns.append(
+                {"name": name, "kind": "array", "dtype": array.dtype.str, "offset": add_buffer(array.tobytes())}
+            )
+
+    meta = json.dumps({"rows": len(leaderboard), "columns": columns}).encode()
+    return _HEADER.pack(LB_MAGIC, LB_FORMAT_VERSION, len(meta)) + meta + b"".join(buffers)
+
+
+def decode_leaderboard(blob):
+    """
+    Reverses encode_leaderboard. Entries cached as DataFrame.to_json() before the binary
+    format was introduced are still read. Returns None for an unknown format version.
+    """
+    if isinstance(blob, str):
+        return pd.read_json(blob)
+    if blob[: len(LB_MAGIC)] != LB_MAGIC:
+        return pd.read_json(bytes(blob).decode())
+
+    _, version, meta_len = _HEADER.unpack_from(blob)
+    if version != LB_FORMAT_VERSION:
+        return None
+
+    meta_start = _HEADER.size
+    meta_end = meta_start + meta_len
+    meta = json.loads(blob[meta_start:meta_end])
+    body = memoryview(blob)[meta_end:]
+    rows = meta["rows"]
+    data = {}
+    for col in meta["columns"]:
+        if col["kind"] == "text":
+            start, length = col["table"]
+            end = start + length
+            table = json.loads(bytes(body[start:end]))
+            codes = np.frombuffer(body, dtype="<i4", count=rows, offset=col["offset"])
+            # a -1 code (missing value) picks the trailing None
+            data[col["name"]] = np.array(table + [None], dtype=object)[codes]
+        else:
+            data[col["name"]] = np.frombuffer(body, dtype=np.dtype(col["dtype"]), count=rows, offset=col["offset"])
+    return pd.DataFrame(data, columns=[col["name"] for col in meta["columns"]])
+
+
+def cache_leaderboard(key, leaderboard, timeout):
+    """Writes the leaderboard to Redis with a new stamp and keeps it in this process, returns its LeaderboardIndex"""
+    stamp = _STAMP_PREFIX + uuid.uuid4().hex
+    REDIS.set_many({_data_key(key): encode_leaderboard(leaderboard), key: stamp}, timeout)
+    return _remember(key, stamp, leaderboard)
+
+
+def cached_leaderboard(key):
+    """
+    Returns the leaderboard stored under key, or None. The returned DataFrame may be shared
+    with other requests in this process and must not be modified in place.
+    """
+    lb_index = cached_leaderboard_index(key)
+    if lb_index is None:
+        return None
+    return lb_index.leaderboard
+
+
+def cached_leaderboard_index(key):
+    """
+    Returns the LeaderboardIndex of the leaderboard stored under key, or None.
+    A local hit still costs one Redis round trip, a GET of the small stamp under key. That keeps
+    invalidation immediate for every worker, and skips fetching and decoding the leaderboard blob.
+    """
+    stamp = REDIS.get(key)
+    if not stamp:
+        return None
+    if not (isinstance(stamp, str) and stamp.startswith(_STAMP_PREFIX)):
+        # written directly under the key before the local tier existed
+        leaderboard = decode_leaderboard(stamp)
+        return None if leaderboard is None else LeaderboardIndex(leaderboard)
+
+    with _local_lock:
+        local = _local_leaderboards.get(key)
+        if local is not None and local[0] == stamp:
+            _local_leaderboards.move_to_end(key)
+            return local[1]
+
+    blob = REDIS.get(_data_key(key))
+    if not blob:
+        return None
+    leaderboard = decode_leaderboard(blob)
+    if leaderboard is None:
+        return None
+    return _remember(key, stamp, leaderboard)
+
+
+def delete_cached_leaderboard(key):
+    """Deletes the leaderboard stored under key: its stamp, its data and the copy in this process"""
+    REDIS.delete_many([key, _data_key(key)])
+    with _local_lock:
+        _local_leaderboards.pop(key, None)
+
+
+def clear_local_leaderboards():
+    with _local_lock:
+        _local_leaderboards.clear()
+
+
+def _remember(key, stamp, leaderboard):
+    lb_index = LeaderboardIndex(leaderboard)
+    with _local_lock:
+        _local_leaderboards[key] = (stamp, lb_index)
+        _local_leaderboards.move_to_end(key)
+        while len(_local_leaderboards) > LOCAL_CACHE_SIZE:
+            _local_leaderboards.popitem(last=False)
+    return lb_index
+
+
+def _data_key(key):
+    return f"{key}:data"
@@ -0,0 +1,116 @@
+from operator import itemgetter
+
+import numpy as np
+import pandas as pd
+
+
+def build_leaderboard_frame(coded_player_answers, answer_tally, lb_cols):
+    """
+    Scores and ranks coded player answers with array operations instead of a per-answer python loop
+    :param coded_player_answers: (player_id, display_name, question_text, coded_answer, is_host) rows ordered by player
+    :param answer_tally: The corresponding answer tally, {question_text: {coded_answer: points}}
+    :param lb_cols: The game question texts, in leaderboard column order
+    :return: A scored, ranked and sorted pandas DataFrame of the Leaderboard
+    """
+    player_ids, is_host, names, matrix = score_matrix(coded_player_answers, answer_tally, lb_cols)
+    leaderboard = pd.DataFrame(matrix.astype("int64"), columns=lb_cols)
+    leaderboard.insert(0, "id", player_ids)
+    leaderboard.insert(1, "is_host", is_host)
+    leaderboard.insert(2, "Name", pd.Series(names, dtype=object))
+    leaderboard = score_and_rank(leaderboard, matrix.sum(axis=1, dtype="int64"))
+    return leaderboard[["id", "is_host", "Rank", "Name", "Score"] + list(lb_cols)]
+
+
+def score_matrix(coded_player_answers, answer_tally, lb_cols):
+    """
+    Maps answers to integer codes and gathers every player's points from per-question lookup arrays
+    :return: player ids, is_host flags and display names (one per player) and a player x question int32 matrix
+    """
+    rows = list(coded_player_answers)
+    if not rows:
+        empty = np.empty(0, dtype="int64")
+        return empty, empty.astype(bool), [], np.zeros((0, len(lb_cols)), dtype="int32")
+
+    # rows arrive grouped by player, a new player starts wherever the id changes
+    p_ids = np.fromiter(map(itemgetter(0), rows), dtype="int64", count=len(rows))
+    is_first = np.ones(len(rows), dtype=bool)
+    is_first[1:] = p_ids[1:] != p_ids[:-1]
+    first_idx = np.flatnonzero(is_first)
+    player_idx = np.cumsum(is_first) - 1
+    player_ids = p_ids[first_idx]
+    names = [rows[i][1] for i in first_idx]
+    is_host = np.fromiter((rows[i][4] for i in first_idx), dtype=bool, count=len(first_idx))
+
+    # -1 codes (unknown question, uncoded answer) index the zero padding row/column of the lookup
+    q_idx = pd.Categorical(list(map(itemgetter(2), rows)), categories=lb_cols).codes.astype("int64")
+    a_idx, a_uniques = pd.factorize(pd.Series(list(map(itemgetter(3), rows)), dtype=object))
+    lookup = tally_lookup(answer_tally, lb_cols, a_uniques)
+
+    matrix = np.zeros((len(player_ids), len(lb_cols) + 1), dtype="int32")
+    matrix[player_idx, q_idx] = lookup[q_idx, a_idx]
+    return player_ids, is_host, names, matrix[:, : len(lb_cols)]
+
+
+def tally_lookup(answer_tally, lb_cols, coded_answers):
+    """
+    A (questions + 1) x (coded answers + 1) int32 array of points, the last row and column are zero padding
+    """
+    code_index = {ans: i for i, ans in enumerate(coded_answers)}
+    lookup = np.zeros((len(lb_cols) + 1, len(coded_answers) + 1), dtype="int32")
+    for q_idx, q_text in enumerate(lb_cols):
+        for ans, points in answer_tally.get(q_text, {}).items():
+            a_idx = code_index.get(ans)
+            if a_idx is not None:
+                lookup[q_idx, a_idx] = points
+    return lookup
+
+
+def score_and_rank(leaderboard, scores):
+    leaderboard["Score"] = np.asarray(scores).astype("int32")
+    leaderboard.sort_values("Score", ascending=False, inplace=True, ignore_index=True)
+    leaderboard["Rank"] = leaderboard["Score"].rank(method="min", ascending=False).astype("int32")
+    return leaderboard
+
+
+def rescore_players(leaderboard, q_text, player_points):
+    """
+    Sets new points on one question for some players and re-ranks them. The untouched rows are
+    still in score order, so the rescored rows are sorted on their own and merged in, instead
+    of sorting the whole leaderboard again
+    :param leaderboard: A scored, ranked and sorted leaderboard, it is not modified
+    :param q_text: The question (leaderboard column) being rescored
+    :param player_points: {player_id: new points for q_text}
+    :return: A new scored, ranked and sorted leaderboard
+    """
+    ids = leaderboard["id"].to_numpy()
+    changed = np.flatnonzero(np.isin(ids, list(player_points)))
+    points = np.array([player_points[p_id] for p_id in ids[changed].tolist()], dtype="int64")
+
+    q_points = leaderboard[q_text].to_numpy(dtype="int64", copy=True)
+    scores = leaderboard["Score"].to_numpy(dtype="int64", copy=True)
+    scores[changed] += points - q_points[changed]
+    q_points[changed] = points
+
+    unchanged = np.setdiff1d(np.arange(len(ids)), changed, assume_unique=True)
+    changed = changed[np.argsort(-scores[changed], kind="stable")]
+
+    # each rescored row goes after the untouched rows with a score >= its own
+    insert_at = np.searchsorted(-scores[unchanged], -scores[changed], side="right")
+    order = np.empty(len(ids), dtype="int64")
+    order[insert_at + np.arange(len(changed))] = changed
+    order[np.arange(len(unchanged)) + np.searchsorted(insert_at, np.arange(len(unchanged)), side="right")] = unchanged
+
+    rescored = leaderboard.copy()
+    rescored[q_text] = q_points
+    rescored["Score"] = scores.astype("int32")
+    rescored = rescored.iloc[order].reset_index(drop=True)
+    rescored["Rank"] = min_ranks(rescored["Score"].to_numpy())
+    return rescored
+
+
+def min_ranks(sorted_scores):
+    """Ranks of descending scores where ties share the best rank, like Series.rank(method="min")"""
+    is_first = np.ones(len(sorted_scores), dtype=bool)
+    is_first[1:] = sorted_scores[1:] != sorted_scores[:-1]
+    first_of_tie = np.maximum.accumulate(np.where(is_first, np.arange(len(sorted_scores)), 0))
+    return (first_of_tie + 1).astype("int32")
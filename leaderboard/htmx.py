@@ -10,7 +10,7 @@ from game.views import SeriesPermissionMixin
 from game.utils import new_players_for_game
 from leaderboard.leaderboard import (
     build_answer_tally,
-    build_filtered_leaderboard,
+    leaderboard_page,
     visible_leaderboards,
     winners_of_series,
 )
@@ -21,6 +21,7 @@ class LeaderboardHTMXView(SeriesPermissionMixin, View):
 
     game_id = None
     game = None
+    page_size = 100
 
     def dispatch(self, request, *args, **kwargs):
         try:
@@ -68,7 +69,6 @@ class LeaderboardHTMXView(SeriesPermissionMixin, View):
         team_id = request.GET.get("team")
         id_filter = request.GET.get("id_filter")
         player_ids = self._player_ids_filter(self.game_id, id_filter)
-        leaderboard = build_filtered_leaderboard(current_game, answer_tally, player_ids, search_term, team_id)
 
         try:
             total_players = current_game.players_dict.count()
@@ -81,8 +81,17 @@ class LeaderboardHTMXView(SeriesPermissionMixin, View):
         except (TypeError, ValueError):
             page = 1
 
-        lb_page_start, lb_page_end, prev_page, next_page, leaderboard, lb_message = self._pagination(
-            leaderboard, page, id_filter
+        leaderboard, filtered_player_count = leaderboard_page(
+            current_game,
+            answer_tally,
+            (page - 1) * self.page_size,
+            page * self.page_size,
+            player_ids,
+            search_term,
+            team_id,
+        )
+        lb_page_start, lb_page_end, prev_page, next_page, lb_message = self._pagination(
+            filtered_player_count, page, id_filter
         )
 
         leaderboard = leaderboard.to_dict(orient="records")
@@ -128,20 +137,17 @@ class LeaderboardHTMXView(SeriesPermissionMixin, View):
             return new_players_for_game(self.slug, self.game_id)
         return []
 
-    def _pagination(self, leaderboard, page, id_filter):
+    def _pagination(self, filtered_player_count, page, id_filter):
         # leaderboard pagination logic
-        lb_page_start = (page - 1) * 100
-        lb_page_end = min(len(leaderboard), page * 100)
-        filtered_player_count = len(leaderboard)
+        lb_page_start = (page - 1) * self.page_size
+        lb_page_end = min(filtered_player_count, page * self.page_size)
 
         prev_page = page - 1 or None
-        if lb_page_end >= len(leaderboard):
+        if lb_page_end >= filtered_player_count:
             next_page = None
         else:
             next_page = page + 1
 
-        leaderboard = leaderboard[lb_page_start:lb_page_end]
-
         if filtered_player_count > 0:
             msg_map = {
                 "following": "players that you follow.",
@@ -160,4 +166,4 @@ class LeaderboardHTMXView(SeriesPermissionMixin, View):
         else:
             msg = mark_safe(f"<a href='/login'>Login</a> or <a href='/join'>Join</a> to follow your friends!")
 
-        return lb_page_start, lb_page_end, prev_page, next_page, leaderboard, msg
+        return lb_page_start, lb_page_end, prev_page, next_page, msg
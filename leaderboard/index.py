@@ -0,0 +1,81 @@
+from collections import defaultdict
+
+import numpy as np
+
+
+class LeaderboardIndex:
+    """
+    Lookup structures over a rank-ordered leaderboard DataFrame, kept next to the cached leaderboard
+    so a page, a name search or an id filter doesn't scan or copy the whole DataFrame.
+    All lookups return row positions in rank order.
+    """
+
+    def __init__(self, leaderboard):
+        self.leaderboard = leaderboard
+        self.ids = leaderboard["id"].to_numpy()
+        self._id_positions = None
+        self._names = None
+        self._trigrams = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def names(self):
+        """Case folded display names by row position"""
+        if self._names is None:
+            self._names = [_fold(n) if isinstance(n, str) else "" for n in self.leaderboard["Name"].tolist()]
+        return self._names
+
+    @property
+    def trigrams(self):
+        """Maps each three character substring of a folded name to the (sorted) positions containing it"""
+        if self._trigrams is None:
+            postings = defaultdict(list)
+            for pos, name in enumerate(self.names):
+                for gram in _trigrams(name):
+                    postings[gram].append(pos)
+            self._trigrams = {gram: np.array(p, dtype="int64") for gram, p in postings.items()}
+        return self._trigrams
+
+    def id_positions(self, player_ids):
+        if self._id_positions is None:
+            self._id_positions = {pid: pos for pos, pid in enumerate(self.ids.tolist())}
+        positions = {self._id_positions[pid] for pid in player_ids if pid in self._id_positions}
+        return np.array(sorted(positions), dtype="int64")
+
+    def search_positions(self, search_term):
+        """Case-insensitive substring search, comma separated terms match any of them. Empty terms are skipped."""
+        positions = set()
+        for term in search_term.split(", "):
+            if term:
+                positions.update(self._term_positions(_fold(term)))
+        return np.array(sorted(positions), dtype="int64")
+
+    def _term_positions(self, term):
+        names = self.names
+        if len(term) < 3:
+            return [pos for pos, name in enumerate(names) if term in name]
+
+        postings = []
+        for gram in _trigrams(term):
+            gram_postings = self.trigrams.get(gram)
+            if gram_postings is None:
+                return []
+            postings.append(gram_postings)
+
+        # intersect the rarest trigrams first, then confirm the full term
+        postings.sort(key=len)
+        candidates = postings[0]
+        for gram_postings in postings[1:]:
+            candidates = np.intersect1d(candidates, gram_postings, assume_unique=True)
+        return [pos for pos in candidates.tolist() if term in names[pos]]
+
+
+def _fold(text):
+    # casefold turns İ into i and a combining dot, a case insensitive regex matches it to a plain i
+    return text.casefold().replace("i\u0307", "i")
+
+
+def _trigrams(text):
+    return {"".join(gram) for gram in zip(text, text[1:], text[2:])}
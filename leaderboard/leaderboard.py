@@ -1,22 +1,36 @@
-import re
 import json
 import math
-from collections import OrderedDict, deque
+import hashlib
+from collections import OrderedDict
 
 from celery import shared_task
+import numpy as np
 import pandas as pd
 
-from django.db.models import Sum, Subquery, OuterRef, F
-from django.db import transaction
+from django.conf import settings
+from django.db.models import Count, F
 
 from project.utils import REDIS, quick_cache, quick_cache_key, redis_delete_patterns, our_now
 from users.models import Player, Team
-from game.models import AnswerCode
-from game.gsheets_api import api_and_db_data_as_df, write_all_to_gdrive, get_sheet_doc
+from game.models import Answer, Question
+from game.gsheets_api import api_and_db_data_as_df, write_all_to_gdrive, get_sheet_doc, clear_responses_sync
 from game.tasks import api_to_db
-from game.rollups import get_user_rollups, build_rollups_dict, build_answer_codes
+from game.rollups import (
+    get_user_rollups,
+    build_rollups_dict,
+    build_answer_codes,
+    cache_autocode_matchers,
+    clear_autocode_matchers,
+    learn_rollups,
+    edited_rollups,
+    with_streamed_rollups,
+    write_rollup_profile,
+)
 from game.utils import number_of_players_in_all_games
-from leaderboard.models import Leaderboard, PlayerRankScore, LeaderboardMessage
+from leaderboard.models import Leaderboard, PlayerRankScore, LeaderboardMessage, LeaderboardSummary
+from leaderboard.engine import build_leaderboard_frame
+from leaderboard.cache import cache_leaderboard, cached_leaderboard_index
+from leaderboard.persistence import upsert_player_rank_scores, prune_player_rank_scores
 
 
 def tabulate_results(game, update=False):
@@ -24,17 +38,27 @@ def tabulate_results(game, update=False):
     Reads from, tabulates, and prints output to the named Google Sheet
     :param game: The game object
     :param update: Whether or not to update existing answer records in the DB
-    :return: None
+    :return: The rollup profile of each question (see profile_process_rollups)
     """
     sheet_doc = get_sheet_doc(game)
     responses = api_and_db_data_as_df(game, sheet_doc)
 
     user_rollups = get_user_rollups(sheet_doc)
     rollups_dict = build_rollups_dict(user_rollups)
-    answer_codes = build_answer_codes(responses, rollups_dict)
+    # only human edits are kept for later games, not the auto codes the sheet was last written with
+    human_rollups = edited_rollups(game, rollups_dict)
+    # answers coded as they were submitted keep their groups, only strings without a code are fuzzy matched
+    rollups_dict = with_streamed_rollups(game, responses, rollups_dict)
+    rollup_profile = []
+    answer_codes = build_answer_codes(
+        responses, rollups_dict, workers=settings.ROLLUP_WORKERS, history=True, profile=rollup_profile
+    )
+    write_rollup_profile(game, rollup_profile)
 
     # write to database
     api_to_db(game, responses.to_json(), answer_codes, update)
+    learn_rollups(game, human_rollups)
+    cache_autocode_matchers(game)
 
     # calculate the question-by-question data and leaderboard
     # NOTE: both of these call the method that rebuilds themself from db and clears the cache
@@ -43,6 +67,9 @@ def tabulate_results(game, update=False):
 
     # write to google
     write_all_to_gdrive(sheet_doc, responses, answer_tally, answer_codes, leaderboard)
+    # the responses sheet now holds the form responses too, the next submission rewrites it from the database
+    clear_responses_sync([game])
+    return rollup_profile
 
 
 def build_filtered_leaderboard(game, answer_tally, player_ids=None, search_term=None, team_id=None):
@@ -56,132 +83,152 @@ def build_filtered_leaderboard(game, answer_tally, player_ids=None, search_term=
     :param team_id: A Team ID to filter players on
     :return: A scored, ranked and sorted pandas DataFrame of the Leaderboard
     """
-    leaderboard = _build_leaderboard_fromdb_or_cache(game, answer_tally)
+    lb_index = _leaderboard_index_fromdb_or_cache(game, answer_tally)
+    positions = _filtered_positions(lb_index, player_ids, search_term, team_id)
+    if positions is None:
+        return lb_index.leaderboard
+    return lb_index.leaderboard.iloc[positions]
+
+
+def leaderboard_page(game, answer_tally, start, stop, player_ids=None, search_term=None, team_id=None):
+    """
+    Same filters as build_filtered_leaderboard, but only the rows [start:stop] of the filtered
+    leaderboard are sliced out of the cached one, so a page costs O(page size) rather than O(players)
+    :return: The page as a DataFrame and the number of players in the filtered leaderboard
+    """
+    lb_index = _leaderboard_index_fromdb_or_cache(game, answer_tally)
+    positions = _filtered_positions(lb_index, player_ids, search_term, team_id)
+    if positions is None:
+        return lb_index.leaderboard.iloc[start:stop], len(lb_index)
+    return lb_index.leaderboard.iloc[positions[start:stop]], len(positions)
 
+
+def _filtered_positions(lb_index, player_ids=None, search_term=None, team_id=None):
+    """Row positions (in rank order) matching all the filters, or None when there are no filters"""
+    filters = []
     if player_ids is not None:
-        leaderboard = leaderboard[leaderboard["id"].isin(player_ids)]
+        filters.append(lb_index.id_positions(player_ids))
 
     if search_term:
-        leaderboard = leaderboard[
-            leaderboard["Name"].str.contains(
-                "|".join([re.escape(q) for q in search_term.split(", ")]), flags=re.IGNORECASE, regex=True
-            )
-        ]
+        filters.append(lb_index.search_positions(search_term))
 
     if team_id:
         team = Team.objects.get(id=team_id)
         members = team.players.values_list("id", flat=True)
-        leaderboard = leaderboard[leaderboard["id"].isin(members)]
+        filters.append(lb_index.id_positions(members))
     # else:
     #     # don't show hosts in public leaderboard (they could be perceived as cheating)
     #     hosts = game.hosts.values_list('id', flat=True)
     #     leaderboard = leaderboard[~leaderboard['id'].isin(hosts)]
 
-    return leaderboard
+    if not filters:
+        return None
+    positions = filters[0]
+    for f in filters[1:]:
+        positions = np.intersect1d(positions, f, assume_unique=True)
+    return positions
 
 
-def _build_leaderboard_fromdb_or_cache(game, answer_tally):
-    lb = _leaderboard_from_cache(game, answer_tally)
-    if lb is None:
-        lb = build_leaderboard_fromdb(game, answer_tally)
-    return lb
+def _leaderboard_index_fromdb_or_cache(game, answer_tally):
+    lb_index = cached_leaderboard_index(lb_cache_key(game, answer_tally))
+    if lb_index is None:
+        lb_index = _build_leaderboard_index_fromdb(game, answer_tally)
+    return lb_index
 
 
 def build_leaderboard_fromdb(game, answer_tally):
-    cpas = deque(game.coded_player_answers)
-    lb_cols = [q_text for q_text in game.game_questions.values_list("text", flat=True)]
+    return _build_leaderboard_index_fromdb(game, answer_tally).leaderboard
 
-    # build list of list to create a dataframe leaderboard
-    # there may be a better way with itertools, but this is at least O(n)
-    # motivated by a desire to reduce the number of db queries (before it was 1/player)
-    lb_data = []
-
-    while cpas:
-        p_id, p_dn, q_text, ans, is_adm = cpas[0]
-        p_data = [p_id, is_adm, p_dn]
-        this_p_id = p_id
-        while this_p_id == p_id and cpas:
-            _, _, q_text, ans, _ = cpas.popleft()
-            try:
-                p_data.append(answer_tally[q_text][ans])
-            except KeyError:
-                # this happens when an answer or player is omitted,
-                # and their answer is a unique string
-                p_data.append(0)
-            if cpas:
-                this_p_id, *_ = cpas[0]
-        lb_data.append(p_data)
-
-    leaderboard = pd.DataFrame(columns=["id", "is_host", "Name"] + lb_cols, data=lb_data)
-    leaderboard = _score_and_rank(leaderboard, lb_cols)
-    leaderboard = leaderboard[["id", "is_host", "Rank", "Name", "Score"] + lb_cols]
-    REDIS.set(lb_cache_key(game, answer_tally), leaderboard.to_json(), 24 * 60 * 60)
-    save_player_rank_scores.delay(leaderboard.to_json(), game.leaderboard.id)
-    return leaderboard
-
-
-def _leaderboard_from_cache(game, answer_tally):
-    lb_json = REDIS.get(lb_cache_key(game, answer_tally))
-    if not lb_json:
-        return None
-    return pd.read_json(lb_json)
+
+def _build_leaderboard_index_fromdb(game, answer_tally):
+    """:return: The LeaderboardIndex cache_leaderboard built for the new leaderboard"""
+    lb_cols = [q_text for q_text in game.game_questions.values_list("text", flat=True)]
+    leaderboard = build_leaderboard_frame(game.coded_player_answers, answer_tally, lb_cols)
+    lb_index = cache_leaderboard(lb_cache_key(game, answer_tally), leaderboard, 24 * 60 * 60)
+    save_leaderboard_rank_scores.delay(game.leaderboard.id, *rank_score_lists(leaderboard))
+    return lb_index
 
 
 @shared_task()
-@transaction.atomic()
 def save_player_rank_scores(lb_json, lb_id):
+    """Saves a leaderboard queued as JSON, for tasks queued before save_leaderboard_rank_scores replaced this one"""
     leaderboard = pd.read_json(lb_json)
-    prs_objs = []
-    for pid, rank, score in zip(leaderboard["id"], leaderboard["Rank"], leaderboard["Score"]):
-        prs_objs.append(PlayerRankScore(leaderboard_id=lb_id, player_id=pid, rank=rank, score=score))
-    if prs_objs:
-        PlayerRankScore.objects.bulk_update_or_create(
-            prs_objs, ["rank", "score"], match_field=("leaderboard_id", "player_id")
-        )
+    return save_leaderboard_rank_scores(lb_id, *rank_score_lists(leaderboard))
+
+
+@shared_task()
+def save_leaderboard_rank_scores(lb_id, player_ids, ranks, scores, complete=True):
+    """
+    :param lb_id: The Leaderboard id
+    :param player_ids: Player ids, with ranks and scores in the same order (see rank_score_lists)
+    :param complete: Whether these are all the players of the leaderboard, the rows of other players are deleted
+    :return: Row count and throughput of the upsert
+    """
+    stats = upsert_player_rank_scores(lb_id, player_ids, ranks, scores)
+    if complete:
+        stats["pruned"] = prune_player_rank_scores(lb_id, player_ids)
+    LeaderboardSummary.refresh(lb_id)
+    return stats
+
+
+def rank_score_lists(leaderboard):
+    """The id, Rank and Score columns as lists of ints, the JSON serializable arguments of save_leaderboard_rank_scores"""
+    return [leaderboard[col].tolist() for col in ("id", "Rank", "Score")]
 
 
 def lb_cache_key(game, answer_tally):
-    return "_".join(("leaderboard", game.series.slug, str(game.game_id), str(hash(json.dumps(answer_tally)))))
+    return lb_cache_prefix(game.series.slug, game.game_id) + answer_tally_version(answer_tally)
+
+
+def lb_cache_prefix(series_slug, game_id):
+    """Every cached leaderboard of a game starts with this prefix, whatever its answer tally"""
+    return f"leaderboard_{series_slug}_{game_id}_"
+
+
+def answer_tally_version(answer_tally):
+    """
+    A content digest of an answer tally. Unlike hash() it is the same in every process and
+    after restarts, so all web and celery workers share one cached leaderboard per tally.
+    """
+    return hashlib.blake2b(json.dumps(answer_tally, sort_keys=True).encode(), digest_size=16).hexdigest()
 
 
 def clear_leaderboard_cache(games):
-    """Deletes all leaderboards and answer tallies for the given games"""
-    lb_prefixes = [f"leaderboard_{g.series.slug}_{g.game_id}" for g in games]
+    """
+    Deletes all leaderboards, answer tallies and instant game autocode matchers for the given games,
+    and has the next responses sheet sync rewrite the sheet
+    """
+    lb_prefixes = [lb_cache_prefix(g.series.slug, g.game_id) for g in games]
     lbs_deleted = redis_delete_patterns(*lb_prefixes)
     at_prefixes = [quick_cache_key(build_answer_tally, g) for g in games]
     ats_deleted = redis_delete_patterns(*at_prefixes)
+    clear_autocode_matchers(Question.objects.filter(game__in=games))
+    clear_responses_sync(games)
     return lbs_deleted, ats_deleted
 
 
-def _score_and_rank(leaderboard, lb_cols):
-    leaderboard["Score"] = leaderboard[lb_cols].sum(axis=1).astype("int32")
-    leaderboard.sort_values("Score", ascending=False, inplace=True, ignore_index=True)
-    leaderboard["Rank"] = leaderboard["Score"].rank(method="min", ascending=False).astype("int32")
-    return leaderboard
-
-
 @quick_cache(24 * 60 * 60)
 def build_answer_tally(game):
-    raw_string_counts = game.valid_raw_string_counts
-    answer_subquery = raw_string_counts.filter(raw_string=OuterRef("raw_string")).filter(question=OuterRef("question"))
+    """
+    Counts the valid answers to each question by coded answer, in a single grouped join of
+    answers to their answer codes on (question, raw_string)
+    :param game: The game object
+    :return: {question_text: OrderedDict({coded_answer: count})}, questions in game order, answers by count
+    """
     answer_counts = (
-        AnswerCode.objects.filter(question__game=game)
-        .order_by("question__number", "question_id")
-        .values("question__text", "coded_answer")
-        .annotate(score=Sum(Subquery(answer_subquery.values("count"))))
+        Answer.objects.filter(
+            question__game=game,
+            removed=False,
+            question__coded_answers__raw_string=F("raw_string"),
+        )
+        .values("question__text", "question__coded_answers__coded_answer")
+        .annotate(score=Count("id"))
+        .order_by("question__number", "question_id", "-score", "question__coded_answers__coded_answer")
     )
     answer_tally = {}
     for a in answer_counts:
-        score = a["score"] or 0
-        if score == 0:
-            continue
-        if a["question__text"] not in answer_tally:
-            answer_tally[a["question__text"]] = {a["coded_answer"]: score}
-        else:
-            answer_tally[a["question__text"]][a["coded_answer"]] = score
-
-    for q, tally in answer_tally.items():
-        answer_tally[q] = OrderedDict(sorted(tally.items(), key=lambda x: -x[1]))
+        q_tally = answer_tally.setdefault(a["question__text"], OrderedDict())
+        q_tally[a["question__coded_answers__coded_answer"]] = a["score"]
     return answer_tally
 
 
@@ -194,6 +241,18 @@ def _answer_tally_from_cache(game):
 
 @quick_cache()
 def player_score_rank_percentile(player, game):
+    summary = LeaderboardSummary.objects.filter(leaderboard__game=game).first()
+    if summary is None:
+        return _player_score_rank_percentile_from_leaderboard(player, game)
+    prs = PlayerRankScore.objects.filter(player=player, leaderboard__game=game).values_list("score", "rank").first()
+    if prs is None:
+        # the rank scores of a new leaderboard are saved asynchronously
+        return _player_score_rank_percentile_from_leaderboard(player, game)
+    score, rank = prs
+    return score, rank, summary.percentile_of_rank(rank)
+
+
+def _player_score_rank_percentile_from_leaderboard(player, game):
     answer_tally = build_answer_tally(game)
     game_leaderboard = build_filtered_leaderboard(game, answer_tally)
     player_result = game_leaderboard[game_leaderboard["id"] == player.id]
@@ -0,0 +1,80 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from project.celery import app
+from leaderboard.benchmarks import (
+    check_synthetic_slug,
+    create_synthetic_game,
+    delete_synthetic_series,
+    benchmark_leaderboard_build,
+    benchmark_leaderboard_engine,
+    benchmark_report,
+)
+
+
+class Command(BaseCommand):
+    help = "Time leaderboard building and serving on a synthetic game and write a JSON report."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--players", type=int, default=1000, help="Number of players, e.g. 1000 to 200000")
+        parser.add_argument("--questions", type=int, default=10)
+        parser.add_argument("--answers", type=int, default=200, help="Distinct coded answers per question")
+        parser.add_argument("--zipf", type=float, default=1.3, help="Zipf exponent of the answer distribution")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument(
+            "--slug", type=str, default="benchmark", help="Slug of the synthetic series, must start with benchmark"
+        )
+        parser.add_argument("--output", type=str, help="Write the report to this file instead of stdout")
+        parser.add_argument("--keep", action="store_true", help="Keep the synthetic series after the run")
+        parser.add_argument(
+            "--engine", action="store_true", help="Also time the leaderboard engine against the legacy loop in memory"
+        )
+
+    def handle(self, *args, **kwargs):
+        scale = {
+            "players": kwargs["players"],
+            "questions": kwargs["questions"],
+            "answers": kwargs["answers"],
+            "zipf": kwargs["zipf"],
+            "seed": kwargs["seed"],
+        }
+        try:
+            check_synthetic_slug(kwargs["slug"])
+        except ValueError as e:
+            raise CommandError(e)
+
+        # player rank scores are saved inline so they're part of the timings
+        always_eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True
+        try:
+            delete_synthetic_series(kwargs["slug"])
+            game = create_synthetic_game(
+                kwargs["slug"],
+                n_players=scale["players"],
+                n_questions=scale["questions"],
+                n_answers=scale["answers"],
+                zipf_a=scale["zipf"],
+                seed=scale["seed"],
+            )
+            try:
+                timings = benchmark_leaderboard_build(game, repeat=kwargs["repeat"])
+            finally:
+                if not kwargs["keep"]:
+                    delete_synthetic_series(kwargs["slug"])
+        finally:
+            app.conf.task_always_eager = always_eager
+
+        report = benchmark_report(timings, **scale)
+        if kwargs["engine"]:
+            report["engine"] = benchmark_leaderboard_engine(
+                n_players=scale["players"], n_questions=scale["questions"], repeat=kwargs["repeat"]
+            )
+        report = json.dumps(report, indent=2)
+        if kwargs["output"]:
+            with open(kwargs["output"], "w") as f:
+                f.write(report)
+            print(f"Wrote benchmark report to {kwargs['output']}")
+        else:
+            print(report)
@@ -0,0 +1,53 @@
+# Generated by Django 3.2.8 on 2026-10-18 12:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_summaries(apps, schema_editor):
+    PlayerRankScore = apps.get_model("leaderboard", "PlayerRankScore")
+    LeaderboardSummary = apps.get_model("leaderboard", "LeaderboardSummary")
+    lb_ids = PlayerRankScore.objects.values_list("leaderboard_id", flat=True).distinct().order_by()
+    for lb_id in lb_ids:
+        histogram = (
+            PlayerRankScore.objects.filter(leaderboard_id=lb_id)
+            .values("score")
+            .annotate(n=models.Count("id"))
+            .order_by("score")
+        )
+        scores = [h["score"] for h in histogram]
+        counts = [h["n"] for h in histogram]
+        ranks = [1 + sum(counts[i + 1 :]) for i in range(len(counts))]
+        LeaderboardSummary.objects.create(
+            leaderboard_id=lb_id, player_count=sum(counts), scores=scores, counts=counts, ranks=ranks
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("leaderboard", "0006_alter_playerrankscore_options"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LeaderboardSummary",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("player_count", models.IntegerField(default=0)),
+                ("scores", models.JSONField(default=list, help_text="The distinct scores, ascending")),
+                ("counts", models.JSONField(default=list, help_text="The number of players with each score")),
+                ("ranks", models.JSONField(default=list, help_text="The rank of each score")),
+                ("updated", models.DateTimeField(auto_now=True)),
+                (
+                    "leaderboard",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="summary",
+                        to="leaderboard.leaderboard",
+                    ),
+                ),
+            ],
+        ),
+        migrations.RunPython(build_summaries, migrations.RunPython.noop),
+    ]
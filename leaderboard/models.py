@@ -1,3 +1,4 @@
+from bisect import bisect_right
 from datetime import timedelta
 from random import choice
 
@@ -75,6 +76,61 @@ class PlayerRankScore(models.Model):
         ordering = ("leaderboard__game__game_id",)
 
 
+class LeaderboardSummary(models.Model):
+    """
+    Denormalized score distribution of a leaderboard, rebuilt from its PlayerRankScores whenever they are saved,
+    so rank and percentile lookups don't need the leaderboard DataFrame.
+    """
+
+    leaderboard = models.OneToOneField(Leaderboard, related_name="summary", on_delete=models.CASCADE)
+    player_count = models.IntegerField(default=0)
+    scores = models.JSONField(default=list, help_text="The distinct scores, ascending")
+    counts = models.JSONField(default=list, help_text="The number of players with each score")
+    ranks = models.JSONField(default=list, help_text="The rank of each score")
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.leaderboard} Summary"
+
+    @classmethod
+    def refresh(cls, leaderboard_id):
+        histogram = (
+            PlayerRankScore.objects.filter(leaderboard_id=leaderboard_id)
+            .values("score")
+            .annotate(n=models.Count("id"))
+            .order_by("score")
+        )
+        scores, counts = [], []
+        for h in histogram:
+            scores.append(h["score"])
+            counts.append(h["n"])
+
+        # a score's rank is one more than the number of players with a higher score
+        ranks = [0] * len(scores)
+        players_above = 0
+        for i in reversed(range(len(scores))):
+            ranks[i] = players_above + 1
+            players_above += counts[i]
+
+        summary, _ = cls.objects.update_or_create(
+            leaderboard_id=leaderboard_id,
+            defaults={"player_count": players_above, "scores": scores, "counts": counts, "ranks": ranks},
+        )
+        return summary
+
+    def rank_of_score(self, score):
+        """The rank a player with this score has, or would have, on the leaderboard"""
+        i = bisect_right(self.scores, score)
+        if i == len(self.scores):
+            return 1
+        return self.ranks[i] + self.counts[i]
+
+    def percentile_of_rank(self, rank):
+        if not self.player_count:
+            return None
+        return round(100 * (1 - rank / self.player_count))
+
+
 class LeaderboardMessage(models.Model):
     metric = models.CharField(
         choices=[("rank", "Rank"), ("percentile", "Percentile")],
@@ -0,0 +1,78 @@
+"""
+Bulk upserts of PlayerRankScores, through COPY and INSERT ... ON CONFLICT in bounded chunks.
+"""
+
+import io
+import logging
+import time
+
+import numpy as np
+from django.db import connection, transaction
+
+from leaderboard.models import PlayerRankScore
+
+logger = logging.getLogger(__name__)
+
+PRS_CHUNK_SIZE = 10000
+_STAGING_TABLE = "prs_staging"
+
+
+def upsert_player_rank_scores(lb_id, player_ids, ranks, scores, chunk_size=PRS_CHUNK_SIZE):
+    """
+    Creates or updates the PlayerRankScores of one leaderboard
+    :param lb_id: The Leaderboard id
+    :param player_ids: Player ids, array-like
+    :param ranks: Ranks aligned with player_ids, array-like
+    :param scores: Scores aligned with player_ids, array-like
+    :param chunk_size: Rows per COPY and transaction
+    :return: {"rows": ..., "seconds": ..., "rows_per_second": ...}
+    """
+    rows = np.column_stack(
+        (np.asarray(player_ids, dtype="int64"), np.asarray(ranks, dtype="int64"), np.asarray(scores, dtype="int64"))
+    )
+    prs_table = PlayerRankScore._meta.db_table
+    upsert_sql = f"""
+        INSERT INTO {prs_table} (leaderboard_id, player_id, rank, score)
+        SELECT %s, player_id, rank, score FROM {_STAGING_TABLE}
+        ON CONFLICT (player_id, leaderboard_id) DO UPDATE
+        SET rank = EXCLUDED.rank, score = EXCLUDED.score
+        WHERE ({prs_table}.rank, {prs_table}.score) IS DISTINCT FROM (EXCLUDED.rank, EXCLUDED.score)
+    """
+
+    start = time.perf_counter()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE TEMPORARY TABLE IF NOT EXISTS {_STAGING_TABLE} (player_id integer, rank integer, score integer)"
+        )
+        try:
+            for chunk_start in range(0, len(rows), chunk_size):
+                chunk_end = chunk_start + chunk_size
+                buffer = io.StringIO()
+                np.savetxt(buffer, rows[chunk_start:chunk_end], fmt="%d", delimiter="\t")
+                buffer.seek(0)
+                with transaction.atomic():
+                    cursor.execute(f"TRUNCATE {_STAGING_TABLE}")
+                    cursor.copy_from(buffer, _STAGING_TABLE, columns=("player_id", "rank", "score"))
+                    cursor.execute(upsert_sql, [lb_id])
+        finally:
+            cursor.execute(f"DROP TABLE IF EXISTS {_STAGING_TABLE}")
+
+    seconds = time.perf_counter() - start
+    stats = {"rows": len(rows), "seconds": seconds, "rows_per_second": len(rows) / seconds if seconds else 0}
+    logger.info(f"Saved {stats['rows']} player rank scores for leaderboard {lb_id}, {stats['rows_per_second']:.0f}/s")
+    return stats
+
+
+def prune_player_rank_scores(lb_id, player_ids):
+    """
+    Deletes the PlayerRankScores of one leaderboard whose player is not in player_ids, e.g. players
+    whose answers were removed since the leaderboard was last saved
+    :return: The number of rows deleted
+    """
+    prs_table = PlayerRankScore._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"DELETE FROM {prs_table} WHERE leaderboard_id = %s AND NOT (player_id = ANY(%s))",
+            [lb_id, [int(p_id) for p_id in player_ids]],
+        )
+        return cursor.rowcount
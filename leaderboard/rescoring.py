@@ -0,0 +1,98 @@
+from collections import Counter, OrderedDict
+
+from django.db import transaction
+
+from project.utils import REDIS, quick_cache_key
+from game.models import Answer, AnswerCode
+from game.rollups import cache_autocode_matcher, learn_rollups
+from leaderboard.cache import cache_leaderboard, delete_cached_leaderboard
+from leaderboard.engine import rescore_players
+from leaderboard.leaderboard import (
+    build_answer_tally,
+    build_filtered_leaderboard,
+    lb_cache_key,
+    rank_score_lists,
+    save_leaderboard_rank_scores,
+)
+
+
+def rescore_answer_codes(game, question, recodes):
+    """
+    Applies new codings to some raw strings of one question without re-running tabulate_results.
+    Only the question's tally, the players holding an affected code and the PlayerRankScores
+    whose rank or score moved are recomputed.
+    :param game: The game object
+    :param question: The question whose AnswerCodes change
+    :param recodes: {raw_string: new coded_answer}
+    :return: The updated answer tally and leaderboard
+    """
+    answer_tally = build_answer_tally(game)
+    leaderboard = build_filtered_leaderboard(game, answer_tally)
+
+    answer_codes = {
+        ac.raw_string: ac for ac in AnswerCode.objects.filter(question=question, raw_string__in=list(recodes))
+    }
+    changed = {
+        raw: code for raw, code in recodes.items() if raw in answer_codes and answer_codes[raw].coded_answer != code
+    }
+    if not changed:
+        return answer_tally, leaderboard
+
+    raw_counts = {
+        rc["raw_string"]: rc["count"]
+        for rc in game.valid_raw_string_counts.filter(question=question, raw_string__in=list(changed))
+    }
+    q_tally = Counter(answer_tally.get(question.text, {}))
+    affected_codes = set()
+    for raw, new_code in changed.items():
+        old_code = answer_codes[raw].coded_answer
+        q_tally[old_code] -= raw_counts.get(raw, 0)
+        q_tally[new_code] += raw_counts.get(raw, 0)
+        affected_codes.update((old_code, new_code))
+        answer_codes[raw].coded_answer = new_code
+
+    with transaction.atomic():
+        AnswerCode.objects.bulk_update([answer_codes[raw] for raw in changed], ["coded_answer"])
+    cache_autocode_matcher(question)
+    learn_rollups(game, {question.text: changed})
+
+    new_tally = OrderedDict(answer_tally)
+    q_tally = OrderedDict(sorted(((c, n) for c, n in q_tally.items() if n > 0), key=lambda x: -x[1]))
+    if q_tally:
+        new_tally[question.text] = q_tally
+    else:
+        new_tally.pop(question.text, None)
+
+    new_leaderboard = leaderboard
+    if question.text in leaderboard.columns:
+        affected_raw_codes = dict(
+            AnswerCode.objects.filter(question=question, coded_answer__in=affected_codes).values_list(
+                "raw_string", "coded_answer"
+            )
+        )
+        player_answers = Answer.objects.filter(
+            question=question,
+            removed=False,
+            raw_string__in=AnswerCode.objects.filter(question=question, coded_answer__in=affected_codes).values(
+                "raw_string"
+            ),
+        ).values_list("player_id", "raw_string")
+        player_points = {p_id: q_tally.get(affected_raw_codes.get(raw), 0) for p_id, raw in player_answers}
+        new_leaderboard = rescore_players(leaderboard, question.text, player_points)
+        _save_moved_rank_scores(game, leaderboard, new_leaderboard)
+
+    REDIS.set(quick_cache_key(build_answer_tally, game), new_tally, 24 * 60 * 60)
+    delete_cached_leaderboard(lb_cache_key(game, answer_tally))
+    cache_leaderboard(lb_cache_key(game, new_tally), new_leaderboard, 24 * 60 * 60)
+    return new_tally, new_leaderboard
+
+
+def _save_moved_rank_scores(game, leaderboard, new_leaderboard):
+    old = leaderboard.set_index("id").loc[new_leaderboard["id"]]
+    moved = (old["Rank"].to_numpy() != new_leaderboard["Rank"].to_numpy()) | (
+        old["Score"].to_numpy() != new_leaderboard["Score"].to_numpy()
+    )
+    if moved.any():
+        save_leaderboard_rank_scores.delay(
+            game.leaderboard.id, *rank_score_lists(new_leaderboard[moved]), complete=False
+        )
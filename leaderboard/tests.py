@@ -1,13 +1,53 @@
 import os
+import json
+import re
+import tempfile
+from copy import deepcopy
+import numpy as np
 import pandas as pd
 
 from django.urls import reverse
-from django.test import Client
+from django.test import Client, SimpleTestCase, TestCase, override_settings
 
 from project.utils import REDIS, our_now, redis_delete_patterns
-from leaderboard.leaderboard import build_filtered_leaderboard, lb_cache_key, winners_of_game, build_leaderboard_fromdb
-from leaderboard.models import PlayerRankScore
-from game.models import Game, Answer
+from leaderboard.leaderboard import (
+    build_filtered_leaderboard,
+    lb_cache_key,
+    winners_of_game,
+    build_leaderboard_fromdb,
+    clear_leaderboard_cache,
+    leaderboard_page,
+    answer_tally_version,
+    build_answer_tally,
+    player_score_rank_percentile,
+    save_leaderboard_rank_scores,
+    rank_score_lists,
+)
+from leaderboard.persistence import upsert_player_rank_scores
+from leaderboard.models import PlayerRankScore, LeaderboardSummary
+from leaderboard.rescoring import rescore_answer_codes
+from leaderboard.engine import build_leaderboard_frame, rescore_players
+from leaderboard.cache import (
+    encode_leaderboard,
+    decode_leaderboard,
+    cached_leaderboard,
+    delete_cached_leaderboard,
+    LB_MAGIC,
+)
+from leaderboard.index import LeaderboardIndex
+from leaderboard.benchmarks import (
+    synthetic_coded_answers,
+    legacy_leaderboard_frame,
+    legacy_answer_tally,
+    create_synthetic_game,
+    delete_synthetic_series,
+    benchmark_leaderboard_build,
+    benchmark_report,
+    benchmark_tabulate_results,
+)
+from game.benchmarks import benchmark_responses_sync
+from game.sheets import get_sheets_backend
+from game.models import Series, Game, Answer, AnswerCode, Question
 from game.tests import BaseGameDataTestCase, suppress_hidden_error_logs
 
 from users.models import Player
@@ -131,6 +171,26 @@ class TestLeaderboardEngine(BaseGameDataTestCase):
         for idx in correct_tally.index:
             self.assertEqual(correct_tally[idx], answer_tally[idx])
 
+    def test_answer_tally_single_query(self):
+        with self.assertNumQueries(1):
+            answer_tally = build_answer_tally.__wrapped__(self.game)
+        legacy_tally = legacy_answer_tally(self.game)
+        self.assertEqual(list(legacy_tally), list(answer_tally))
+        for q_text, q_tally in legacy_tally.items():
+            self.assertDictEqual(dict(q_tally), dict(answer_tally[q_text]))
+            self.assertEqual(list(answer_tally[q_text].values()), sorted(q_tally.values(), reverse=True))
+
+    def test_answer_tally_version(self):
+        # content addressed: independent of dict ordering and of the process (no hash randomization)
+        reordered = {q: dict(reversed(list(tally.items()))) for q, tally in reversed(list(self.answer_tally.items()))}
+        self.assertEqual(answer_tally_version(self.answer_tally), answer_tally_version(reordered))
+
+        changed = deepcopy(self.answer_tally)
+        q_text = next(iter(changed))
+        changed[q_text][next(iter(changed[q_text]))] += 1
+        self.assertNotEqual(answer_tally_version(self.answer_tally), answer_tally_version(changed))
+        self.assertTrue(lb_cache_key(self.game, self.answer_tally).endswith(answer_tally_version(self.answer_tally)))
+
     def test_build_leaderboard(self):
         expected_leaderboard = self._expected_leaderboard()
         expected_leaderboard.rename(columns={"Name (First & Last)": "Name"}, inplace=True)
@@ -163,7 +223,7 @@ class TestLeaderboardEngine(BaseGameDataTestCase):
         # basic leaderboard search
         filtered_leaderboard = build_filtered_leaderboard(self.game, self.answer_tally, search_term="5")
         self.assertEqual(len(filtered_leaderboard), 3)
-        REDIS.delete(lb_cache_key(self.game, self.answer_tally))
+        delete_cached_leaderboard(lb_cache_key(self.game, self.answer_tally))
 
         # make sure regex is escaped, search for literals
         user5 = Player.objects.get(display_name="User 5")
@@ -206,6 +266,109 @@ class TestLeaderboardEngine(BaseGameDataTestCase):
         leaderboard = build_filtered_leaderboard(self.game, self.answer_tally)
         self.assertEqual(len(leaderboard), len(self.leaderboard) - 1)
 
+    def test_leaderboard_page(self):
+        page, filtered_count = leaderboard_page(self.game, self.answer_tally, 0, 10)
+        self.assertEqual(filtered_count, len(self.leaderboard))
+        self.assertEqual(page["id"].tolist(), self.leaderboard["id"].tolist()[:10])
+
+        page, filtered_count = leaderboard_page(self.game, self.answer_tally, 1, 10, search_term="5")
+        self.assertEqual(filtered_count, 3)
+        self.assertEqual(len(page), 2)
+
+    def test_local_leaderboard_cache(self):
+        key = lb_cache_key(self.game, self.answer_tally)
+        build_filtered_leaderboard(self.game, self.answer_tally)
+
+        # repeated reads in this process share one decoded leaderboard
+        self.assertIs(cached_leaderboard(key), cached_leaderboard(key))
+
+        # a rebuild replaces the local copy
+        local_lb = cached_leaderboard(key)
+        build_leaderboard_fromdb(self.game, self.answer_tally)
+        self.assertIsNot(cached_leaderboard(key), local_lb)
+
+        # deleting the redis entry invalidates the local copy
+        clear_leaderboard_cache([self.game])
+        self.assertIsNone(cached_leaderboard(key))
+
+    def test_rescore_answer_codes(self):
+        question = Question.objects.get(game=self.game, text="Name a province in Canada.")
+        ottowa_raw = list(
+            AnswerCode.objects.filter(question=question, coded_answer="Ottowa").values_list("raw_string", flat=True)
+        )
+        player = Answer.objects.filter(question=question, raw_string__in=ottowa_raw).first().player
+        original_score = PlayerRankScore.objects.get(player=player, leaderboard=self.leaderboard_obj).score
+
+        # merge Ottowa into Ontario
+        tally, leaderboard = rescore_answer_codes(self.game, question, {raw: "Ontario" for raw in ottowa_raw})
+        self.assertEqual(tally[question.text]["Ontario"], 11)
+        self.assertNotIn("Ottowa", tally[question.text])
+        self.assertEqual(AnswerCode.objects.get(question=question, raw_string=ottowa_raw[0]).coded_answer, "Ontario")
+
+        # same ranks and scores as a full rebuild
+        full_leaderboard = build_leaderboard_fromdb(self.game, build_answer_tally(self.game, force_refresh=True))
+        rank_scores = ["id", "Rank", "Score"]
+        pd.testing.assert_frame_equal(
+            full_leaderboard.sort_values("id")[rank_scores].reset_index(drop=True),
+            leaderboard.sort_values("id")[rank_scores].reset_index(drop=True),
+        )
+        new_score = PlayerRankScore.objects.get(player=player, leaderboard=self.leaderboard_obj).score
+        self.assertEqual(new_score, original_score + 10 - 1)
+
+        # and back again
+        tally, _ = rescore_answer_codes(self.game, question, {raw: "Ottowa" for raw in ottowa_raw})
+        self.assertEqual(answer_tally_version(tally), answer_tally_version(self.answer_tally))
+        restored_score = PlayerRankScore.objects.get(player=player, leaderboard=self.leaderboard_obj).score
+        self.assertEqual(restored_score, original_score)
+
+    def test_leaderboard_summary(self):
+        leaderboard = build_filtered_leaderboard(self.game, self.answer_tally)
+        summary = LeaderboardSummary.objects.get(leaderboard=self.leaderboard_obj)
+        self.assertEqual(summary.player_count, len(leaderboard))
+        self.assertEqual(sum(summary.counts), len(leaderboard))
+        for score, rank in zip(leaderboard["Score"], leaderboard["Rank"]):
+            self.assertEqual(summary.rank_of_score(score), rank)
+
+        # hypothetical scores rank behind everyone with a higher score
+        top_score = leaderboard["Score"].max()
+        self.assertEqual(summary.rank_of_score(top_score + 1), 1)
+        self.assertEqual(summary.rank_of_score(-1), len(leaderboard) + 1)
+
+        player = Player.objects.get(id=leaderboard["id"].iloc[-1])
+        with self.assertNumQueries(2):
+            score, rank, percentile = player_score_rank_percentile(player, self.game, force_refresh=True)
+        self.assertEqual(score, leaderboard["Score"].iloc[-1])
+        self.assertEqual(rank, leaderboard["Rank"].iloc[-1])
+        self.assertEqual(percentile, round(100 * (1 - rank / len(leaderboard))))
+
+    def test_upsert_player_rank_scores(self):
+        leaderboard = build_filtered_leaderboard(self.game, self.answer_tally)
+        player_ids = leaderboard["id"].to_numpy()
+        ranks = leaderboard["Rank"].to_numpy()[::-1]
+        scores = leaderboard["Score"].to_numpy() + 1
+
+        stats = upsert_player_rank_scores(self.leaderboard_obj.id, player_ids, ranks, scores, chunk_size=4)
+        self.assertEqual(stats["rows"], len(leaderboard))
+        saved = dict(PlayerRankScore.objects.filter(leaderboard=self.leaderboard_obj).values_list("player_id", "rank"))
+        self.assertDictEqual(saved, dict(zip(player_ids.tolist(), ranks.tolist())))
+        self.assertEqual(
+            PlayerRankScore.objects.get(leaderboard=self.leaderboard_obj, player_id=player_ids[0]).score, scores[0]
+        )
+
+        # and back through the task, which also refreshes the summary
+        save_leaderboard_rank_scores(self.leaderboard_obj.id, *rank_score_lists(leaderboard))
+        summary = LeaderboardSummary.objects.get(leaderboard=self.leaderboard_obj)
+        self.assertEqual(summary.rank_of_score(leaderboard["Score"].iloc[0]), 1)
+
+        # saving a leaderboard deletes the rank scores of players no longer on it
+        save_leaderboard_rank_scores(self.leaderboard_obj.id, *rank_score_lists(leaderboard.iloc[1:]))
+        prs = PlayerRankScore.objects.filter(leaderboard=self.leaderboard_obj)
+        self.assertEqual(prs.count(), len(leaderboard) - 1)
+        self.assertFalse(prs.filter(player_id=player_ids[0]).exists())
+        self.assertEqual(
+            LeaderboardSummary.objects.get(leaderboard=self.leaderboard_obj).player_count, len(leaderboard) - 1
+        )
+
     def test_save_player_rank_scores(self):
         player = Player.objects.get(email="user1@fakeemail.com")
         player_prs_qs = PlayerRankScore.objects.filter(player=player)
@@ -220,3 +383,174 @@ class TestLeaderboardEngine(BaseGameDataTestCase):
         build_leaderboard_fromdb(self.game, self.answer_tally)
         new_value = PlayerRankScore.objects.filter(player=player).first().score
         self.assertEqual(original_value, new_value)
+
+
+class TestLeaderboardBenchmarks(TestCase):
+
+    def tearDown(self):
+        clear_leaderboard_cache(Game.objects.filter(series__slug="benchmark-test"))
+        get_sheets_backend("local").clear()
+
+    def test_synthetic_game_benchmark(self):
+        game = create_synthetic_game("benchmark-test", n_players=200, n_questions=5, n_answers=20)
+        self.assertEqual(game.players_dict.count(), 200)
+        answer_tally = build_answer_tally(game, force_refresh=True)
+        self.assertEqual(sum(sum(tally.values()) for tally in answer_tally.values()), 200 * 5)
+
+        timings = benchmark_leaderboard_build(game, repeat=1)
+        self.assertListEqual(
+            list(timings),
+            [
+                "build_answer_tally",
+                "build_leaderboard_fromdb",
+                "build_filtered_leaderboard",
+                "build_filtered_leaderboard_search",
+                "save_leaderboard_rank_scores",
+                "htmx_leaderboard",
+            ],
+        )
+        report = benchmark_report(timings, players=200, questions=5)
+        self.assertEqual(json.loads(json.dumps(report))["scale"], {"players": 200, "questions": 5})
+        self.assertEqual(PlayerRankScore.objects.filter(leaderboard=game.leaderboard).count(), 200)
+
+    @override_settings(ROLLUP_WORKERS=1)
+    def test_offline_tabulation_benchmark(self):
+        game = create_synthetic_game("benchmark-test", n_players=50, n_questions=3, n_answers=10)
+        with tempfile.TemporaryDirectory() as root, override_settings(ROLLUP_PROFILE_ROOT=root):
+            timings = benchmark_tabulate_results(game)
+        self.assertEqual(len(timings["runs"]), 1)
+        sheet_doc = get_sheets_backend("local").open(game.leaderboard.sheet_name)
+        self.assertEqual(len(sheet_doc.values_get("[auto] leaderboard")["values"]), 50 + 1)
+
+        sync_timings = benchmark_responses_sync(game, repeat=1)
+        self.assertGreater(sync_timings["rewrite_seconds"], 0)
+        self.assertEqual(game.players_dict.count(), 50)
+
+    def test_synthetic_slug_guard(self):
+        with self.assertRaises(ValueError):
+            delete_synthetic_series("trivia-night")
+        with self.assertRaises(ValueError):
+            create_synthetic_game("trivia-night", n_players=1)
+        self.assertFalse(Series.objects.filter(slug="trivia-night").exists())
+
+
+class TestLeaderboardEngineArrays(SimpleTestCase):
+
+    def test_matches_legacy_leaderboard(self):
+        cpas, answer_tally, lb_cols = synthetic_coded_answers(n_players=2000, n_questions=10)
+        pd.testing.assert_frame_equal(
+            legacy_leaderboard_frame(cpas, answer_tally, lb_cols), build_leaderboard_frame(cpas, answer_tally, lb_cols)
+        )
+
+    def test_unscored_answers(self):
+        cpas = [(1, "A", "q1", "yes", False), (1, "A", "q2", None, False), (2, "B", "q1", "no", True)]
+        answer_tally = {"q1": {"yes": 2, "no": 1}}
+        leaderboard = build_leaderboard_frame(cpas, answer_tally, ["q1", "q2"])
+        self.assertEqual(leaderboard["id"].tolist(), [1, 2])
+        self.assertEqual(leaderboard["Score"].tolist(), [2, 1])
+        self.assertEqual(leaderboard["q2"].tolist(), [0, 0])
+        self.assertEqual(leaderboard["is_host"].tolist(), [False, True])
+
+    def test_empty_leaderboard(self):
+        leaderboard = build_leaderboard_frame([], {}, ["q1"])
+        self.assertEqual(list(leaderboard.columns), ["id", "is_host", "Rank", "Name", "Score", "q1"])
+        self.assertEqual(len(leaderboard), 0)
+
+
+class TestLeaderboardCacheFormat(SimpleTestCase):
+
+    def setUp(self):
+        cpas, answer_tally, lb_cols = synthetic_coded_answers(n_players=500, n_questions=5)
+        self.leaderboard = build_leaderboard_frame(cpas, answer_tally, lb_cols)
+
+    def test_binary_round_trip(self):
+        blob = encode_leaderboard(self.leaderboard)
+        self.assertTrue(blob.startswith(LB_MAGIC))
+        pd.testing.assert_frame_equal(self.leaderboard, decode_leaderboard(blob))
+
+    def test_missing_names(self):
+        self.leaderboard.loc[0, "Name"] = None
+        decoded = decode_leaderboard(encode_leaderboard(self.leaderboard))
+        self.assertIsNone(decoded.loc[0, "Name"])
+
+    def test_reads_legacy_json(self):
+        decoded = decode_leaderboard(self.leaderboard.to_json())
+        self.assertEqual(decoded["id"].tolist(), self.leaderboard["id"].tolist())
+        self.assertEqual(decoded["Rank"].tolist(), self.leaderboard["Rank"].tolist())
+
+    def test_unknown_version_is_a_miss(self):
+        blob = bytearray(encode_leaderboard(self.leaderboard))
+        blob[len(LB_MAGIC)] = 255
+        self.assertIsNone(decode_leaderboard(bytes(blob)))
+
+
+class TestLeaderboardIndex(SimpleTestCase):
+
+    def setUp(self):
+        self.leaderboard = pd.DataFrame(
+            {
+                "id": [7, 3, 9, 1, 4, 8],
+                "Name": ["Alice Smith", "bob", "*5*", "ALICIA", "Robert Bobson", "İstanbul Ian"],
+            }
+        )
+        self.lb_index = LeaderboardIndex(self.leaderboard)
+
+    def _expected(self, search_term):
+        pattern = "|".join([re.escape(q) for q in search_term.split(", ")])
+        matches = self.leaderboard["Name"].str.contains(pattern, flags=re.IGNORECASE, regex=True)
+        return list(np.flatnonzero(matches.to_numpy()))
+
+    def test_search_matches_regex_filter(self):
+        for search_term in ("ali", "BOB", "*5*", "li", "smith, bob", "zzz", "a", "istanbul", "İSTANBUL"):
+            self.assertEqual(list(self.lb_index.search_positions(search_term)), self._expected(search_term))
+
+    def test_search_skips_empty_terms(self):
+        lb_index = LeaderboardIndex(pd.DataFrame({"id": [1, 2, 3], "Name": ["Ann", None, "Bob"]}))
+        self.assertEqual(list(lb_index.search_positions("ann, ")), [0])
+        self.assertEqual(list(lb_index.search_positions("")), [])
+
+    def test_id_positions(self):
+        self.assertEqual(list(self.lb_index.id_positions([4, 7, 100])), [0, 4])
+        self.assertEqual(list(self.lb_index.id_positions({3: True})), [1])
+        self.assertEqual(list(self.lb_index.id_positions([])), [])
+
+
+class TestLeaderboardSummaryLookups(SimpleTestCase):
+
+    def test_rank_of_score(self):
+        # scores 10, 10, 7, 3, 3, 3
+        summary = LeaderboardSummary(player_count=6, scores=[3, 7, 10], counts=[3, 1, 2], ranks=[4, 3, 1])
+        self.assertEqual(summary.rank_of_score(11), 1)
+        self.assertEqual(summary.rank_of_score(10), 1)
+        self.assertEqual(summary.rank_of_score(8), 3)
+        self.assertEqual(summary.rank_of_score(7), 3)
+        self.assertEqual(summary.rank_of_score(3), 4)
+        self.assertEqual(summary.rank_of_score(0), 7)
+        self.assertEqual(summary.percentile_of_rank(3), 50)
+        self.assertIsNone(LeaderboardSummary().percentile_of_rank(1))
+
+
+class TestLeaderboardRescoring(SimpleTestCase):
+
+    def test_rescore_players_matches_full_build(self):
+        cpas, answer_tally, lb_cols = synthetic_coded_answers(n_players=3000, n_questions=6, n_answers=30)
+        leaderboard = build_leaderboard_frame(cpas, answer_tally, lb_cols)
+
+        # merge "answer 0" into "answer 1" on one question
+        q_text = lb_cols[2]
+        new_tally = deepcopy(answer_tally)
+        new_tally[q_text]["answer 1"] += new_tally[q_text].pop("answer 0")
+        player_points = {
+            p_id: new_tally[q_text].get(ans, 0)
+            for p_id, _, q, ans, _ in cpas
+            if q == q_text and ans in ("answer 0", "answer 1")
+        }
+        rescored = rescore_players(leaderboard, q_text, player_points)
+        expected = build_leaderboard_frame(cpas, new_tally, lb_cols)
+
+        by_id = ["id", "Rank", "Score", q_text]
+        pd.testing.assert_frame_equal(
+            expected.sort_values("id")[by_id].reset_index(drop=True),
+            rescored.sort_values("id")[by_id].reset_index(drop=True),
+        )
+        self.assertTrue((np.diff(rescored["Score"].to_numpy()) <= 0).all())
@@ -24,7 +24,7 @@ from leaderboard.leaderboard import (
     visible_leaderboards,
 )
 from leaderboard.tasks import save_last_visit_t
-from leaderboard.models import PlayerRankScore
+from leaderboard.models import PlayerRankScore, LeaderboardSummary
 
 logger = logging.getLogger(__name__)
 
@@ -146,13 +146,14 @@ class LeaderboardView(BaseGameView):
         for qid, player_answer in self._player_answers_from_session(request).items():
             player_score += answer_tally[qid_to_text[qid]][player_answer]
 
-        adjacent_rank = (
-            PlayerRankScore.objects.filter(leaderboard__game=self.game, score__gt=player_score)
-            .order_by("score")
-            .first()
-        )
-        player_rank = adjacent_rank.rank + 1 if adjacent_rank else 1
-        player_percentile = round(100 * (1 - player_rank / self.game.players_dict.count()))
+        summary = LeaderboardSummary.objects.filter(leaderboard__game=self.game).first()
+        if summary is not None:
+            player_rank = summary.rank_of_score(player_score)
+            player_percentile = summary.percentile_of_rank(player_rank)
+        else:
+            higher_scores = PlayerRankScore.objects.filter(leaderboard__game=self.game, score__gt=player_score)
+            player_rank = higher_scores.count() + 1
+            player_percentile = round(100 * (1 - player_rank / self.game.players_dict.count()))
         return player_score, player_rank, player_percentile
 
 
@@ -58,6 +58,12 @@ if env.get("EAGER_CELERY", False):
 
 DEFAULT_AUTO_FIELD = "django.db.models.AutoField"
 
+# processes used to auto-code the questions of a game in parallel when tabulating results, each one
+# starts its own interpreter and django app, so it only pays off for games with many answers
+ROLLUP_WORKERS = int(env.get("ROLLUP_WORKERS", 1))
+# the similarity backend used to auto-code answers, see game.similarity
+ROLLUP_SCORER = env.get("ROLLUP_SCORER", "fuzzywuzzy")
+
 INSTALLED_APPS = [
     "channels",
     "sslserver",
@@ -225,6 +231,7 @@ CKEDITOR_IMAGE_BACKEND = "pillow"
 MEDIA_URL = "/media/"
 MEDIA_ROOT = "media/"
 WINNER_ROOT = os.path.join(MEDIA_ROOT, "WinnerCertificates/")
+ROLLUP_PROFILE_ROOT = os.path.join(MEDIA_ROOT, "RollupProfiles/")
 WINNER_TEMPLATE_PDF = "game/templates/game/WinnerCertificate.pdf"
 
 if env.get("ENABLE_MAIL"):
@@ -246,6 +253,13 @@ SLACK_TOKEN = env.get("SLACK_TOKEN")
 
 GOOGLE_GSPREAD_API_CONFIG = os.path.join(BASE_DIR, ".config/gspread/commonology_service_account.json")
 GOOGLE_DRIVE_FOLDER_ID = env.get("GOOGLE_DRIVE_FOLDER_ID")
+# where game spreadsheets are read and written, see game.sheets
+SHEETS_BACKEND = env.get("SHEETS_BACKEND", "gspread")
+# the local backend keeps spreadsheets in memory unless given a directory, and can sleep on each call
+LOCAL_SHEETS_ROOT = env.get("LOCAL_SHEETS_ROOT")
+LOCAL_SHEETS_LATENCY = float(env.get("LOCAL_SHEETS_LATENCY", 0))
+# seconds between syncs of a game's responses sheet, the Sheets API allows 60 writes a minute per user
+RESPONSES_SYNC_INTERVAL = float(env.get("RESPONSES_SYNC_INTERVAL", 5))
 
 # There is a weird bug with logtail enabled and the auto-reload development server,
 # this is so the logger doesn't try to configure logtail locally
@@ -14,6 +14,7 @@ from django.conf import settings
 from project.card_views import BaseCardView, CardFormView, recaptcha_check
 from project.utils import ANALYTICS_REDIS
 from game.utils import next_event, find_latest_public_game
+from game.rollups import autocode_cache_stats
 
 import logging
 
@@ -127,6 +128,11 @@ def instant_player_stats(request):
             resp + f"{source.upper()}: There have been {starts} instant "
             f"game starts and {completes} completes.<br/><br/>"
         )
+    autocodes = autocode_cache_stats()
+    resp = (
+        resp + f"AUTOCODING: {autocodes['local_hits']} answers were remembered by a worker, "
+        f"{autocodes['redis_hits']} by Redis and {autocodes['misses']} had to be fuzzy matched.<br/><br/>"
+    )
     return HttpResponse(mark_safe(resp))
 
 
@@ -431,6 +431,20 @@ class Player(CustomUser):
                     flag = False
             self._code = code
 
+    @classmethod
+    def unique_codes(cls, n):
+        """
+        Codes for players that are bulk created and skip set_code
+        :param n: Number of codes
+        :return: List of n distinct codes not used by any player
+        """
+        codes = set()
+        while len(codes) < n:
+            candidates = {secrets.token_urlsafe()[:5] for _ in range(n - len(codes))} - codes
+            taken = set(cls.objects.filter(_code__in=candidates).values_list("_code", flat=True))
+            codes |= candidates - taken
+        return list(codes)
+
     def __str__(self):
         return self.email
 
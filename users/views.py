@@ -34,7 +34,7 @@ from project.views import make_play_qr
 from project.utils import redis_delete_patterns, our_now
 from game.models import Series
 from game.utils import find_latest_published_game
-from leaderboard.leaderboard import player_top_game_rank, player_top_game_percentile
+from leaderboard.leaderboard import player_top_game_rank, player_top_game_percentile, lb_cache_prefix
 from leaderboard.models import PlayerRankScore
 from .utils import remove_pending_email_invitations
 
@@ -123,7 +123,7 @@ class ProfileView(LoginRequiredMixin, CardFormView):
         if "display_name" in form.changed_data:
             # we need to clear leaderboards this person appears on from cache to propagate change
             played_game_ids = user.game_ids
-            redis_delete_patterns(*[f'leaderboard_{g["game_id"]}' for g in played_game_ids])
+            redis_delete_patterns(*[lb_cache_prefix(g["series"], g["game_id"]) for g in played_game_ids])
 
         form.save()
         messages.info(request, "Your changes have been saved!")